@@ -0,0 +1,109 @@
+# Asyncio runtime for the bot fleet
+
+import asyncio
+import functools
+
+import executors
+
+
+class Offloader:
+    """
+    Runs blocking calls (tweepy, boto3, psycopg2) for coroutines on one of the
+    BoundedExecutors in executors.py, so they never block the event loop.
+
+    At most as many calls as the pool has workers are handed to it at once. The rest
+    wait on the event loop, where a waiting call costs a coroutine instead of a
+    thread or a slot in the pool's queue, so calls are not rejected when many bots
+    are due at the same time.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._slots = None # Created on first use, on the event loop that uses it
+
+    async def run(self, fn, *args):
+        # Returns fn(*args), run on the pool, or None if the pool rejected it
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool.workers)
+
+        async with self._slots:
+            future = self.pool.submit(fn, *args)
+            if future is None:
+                return None
+            return await asyncio.wrap_future(future)
+
+
+class AsyncJobGuard(executors.BaseJobGuard):
+    """
+    The asyncio counterpart of executors.JobGuard, with the same overrun policies.
+    Each run is a task on the event loop that hands the job to an Offloader, so
+    dispatch() must be called on the event loop. Under the cancel policy, a run
+    that is still waiting for the Offloader is cancelled outright, like a run still
+    queued in a JobGuard's executor.
+
+    cancelled and wait() are called from the thread that runs the job, and behave
+    as in JobGuard, so Bot.cancelled works the same under both runtimes.
+    """
+
+    def _submit(self, offloader, run, fn):
+        return asyncio.ensure_future(self._drive(offloader, run, fn))
+
+    async def _drive(self, offloader, run, fn):
+        try:
+            await offloader.run(self._call, run, fn)
+        except asyncio.CancelledError:
+            pass # Cancelled while waiting for the offloader
+        except Exception:
+            pass # Already printed by the executor
+        finally:
+            self._finish(run)
+
+
+def create_offloaders(pools):
+    # Wraps every worker pool from executors.create_executors in an Offloader
+    return {name: Offloader(pool) for name, pool in pools.items()}
+
+
+def install_guards(bots, overrun):
+    # Gives each bot an AsyncJobGuard per job, in place of the JobGuards Bot.guard creates
+    for bot in bots:
+        for job, policy in overrun.items():
+            bot.guards[job] = AsyncJobGuard("{0}: {1}".format(bot.screen_name, job), policy)
+
+
+def _report(name, task):
+    if not task.cancelled() and task.exception() is not None:
+        print("Job {0} failed. Reason: {1}".format(name, task.exception()))
+
+
+def spawn(name, coroutine_function, *args):
+    """
+    Returns a scheduler action that starts coroutine_function(*args) as a task on the
+    event loop and returns at once. Errors are printed when the task finishes.
+    """
+    def action():
+        task = asyncio.ensure_future(coroutine_function(*args))
+        task.add_done_callback(functools.partial(_report, name))
+
+    return action
+
+
+async def _main(scheduler, startup):
+    for action in startup:
+        action()
+    await scheduler.run_async()
+
+
+def run(scheduler, startup=()):
+    """
+    Runs the scheduler (see Scheduler.run_async) on a new event loop until it has no
+    jobs. The startup actions (for example from spawn) are called first, once the
+    loop is running, so the tasks they start run on that loop.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_main(scheduler, startup))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
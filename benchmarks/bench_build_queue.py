@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import random
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import queues
+
+"""
+Benchmark for queue generation (queues.build_queue).
+
+Times queue generation for pools of 1k, 10k, 100k and 1M keys with recent_limit
+values from 96 to 10k, and compares it with the old list-based split that
+smart_queue used to do ("row in recent_queue" on a list, twice).
+
+Run from the repository root:
+
+python benchmarks/bench_build_queue.py
+
+The old split is O(pool x recent_limit), so it is skipped when that product is
+above 10^8 unless --all is given.
+
+queues.build_weighted_queue is timed too (with a post history for a fifth of the
+pool), unless NumPy is not installed.
+"""
+
+POOL_SIZES = [1000, 10000, 100000, 1000000]
+RECENT_LIMITS = [96, 1000, 10000]
+
+
+def legacy_build_queue(file_pool, recent_queue, recent_limit):
+    # The list-based algorithm smart_queue used before build_queue
+    new_queue = []
+
+    temp = [row for row in file_pool if row not in recent_queue]
+    temp2 = [row for row in file_pool if row in recent_queue]
+    random.shuffle(temp)
+
+    end = len(temp) if len(temp) < recent_limit else recent_limit
+    for i in range(end):
+        new_queue.append(temp.pop())
+
+    temp = temp + temp2
+    random.shuffle(temp)
+
+    return new_queue + temp
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    run_all = '--all' in sys.argv
+
+    try:
+        import numpy
+        weighted_enabled = True
+    except ImportError:
+        weighted_enabled = False
+
+    now = datetime.datetime.now()
+
+    print("{:>9} {:>8} {:>16} {:>16} {:>16}".format("pool", "recent", "build_queue (s)", "legacy (s)", "weighted (s)"))
+    for pool_size in POOL_SIZES:
+        file_pool = ["idol/{:08d}.png".format(i) for i in range(pool_size)]
+
+        for recent_limit in RECENT_LIMITS:
+            if recent_limit > pool_size:
+                continue
+
+            recent_queue = random.sample(file_pool, recent_limit)
+            last_posted = {key: now - datetime.timedelta(seconds=random.randrange(60 * 86400))
+                           for key in random.sample(file_pool, pool_size // 5)}
+
+            elapsed = time_call(queues.build_queue, file_pool, recent_queue, recent_limit)
+
+            if run_all or pool_size * recent_limit <= 10 ** 8:
+                legacy = "{:.3f}".format(time_call(legacy_build_queue, file_pool, recent_queue, recent_limit))
+            else:
+                legacy = "skipped"
+
+            if weighted_enabled:
+                weighted = "{:.3f}".format(time_call(queues.build_weighted_queue, file_pool, recent_queue, recent_limit, last_posted, 30 * 86400))
+            else:
+                weighted = "skipped"
+
+            print("{:>9} {:>8} {:>16.3f} {:>16} {:>16}".format(pool_size, recent_limit, elapsed, legacy, weighted))
+
+
+if __name__ == "__main__":
+    main()
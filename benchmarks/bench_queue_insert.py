@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+
+"""
+Benchmark for writing a freshly shuffled queue to the database.
+
+Compares the old row-by-row INSERT loop with database.insert_queue (batched
+multi-row INSERT) for queues of 1k, 10k and 100k entries. A temporary table is
+used, so nothing is written to the real queue tables. The row-by-row loop ordered
+the queue by timestamp, so the number of rows that tie with another row's
+timestamp is shown for it; insert_queue orders by id and cannot tie.
+
+Run from the repository root:
+
+python benchmarks/bench_queue_insert.py [sizes...]
+
+The row-by-row loop is skipped for sizes above 10000 unless --all is given, since
+it takes several minutes against a remote database.
+"""
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'keys.json')) as key_data:
+    key_dict = json.load(key_data)
+
+    database_url = key_dict['app']['database_url']
+
+
+def insert_row_by_row(cur, table_name, bot, filepaths):
+    for filepath in filepaths[::-1]:
+        timestamp = str(datetime.datetime.now())
+        cur.execute("INSERT INTO {0} (bot, filepath, comment, timestamp) VALUES (%s, %s, %s, %s)".format(table_name), (bot, filepath, None, timestamp))
+
+
+def time_insert(pool, function, filepaths):
+    with pool.cursor() as cur:
+        cur.execute("CREATE TEMPORARY TABLE bench_queue (id bigserial PRIMARY KEY, bot text, filepath text, comment text, timestamp timestamp)")
+
+        start = time.perf_counter()
+        function(cur, 'bench_queue', 'bench', filepaths)
+        elapsed = time.perf_counter() - start
+
+        # Count distinct timestamps to show how ambiguous the resulting order is
+        cur.execute("SELECT count(DISTINCT timestamp) FROM bench_queue")
+        distinct = cur.fetchone()[0]
+
+        cur.execute("DROP TABLE bench_queue")
+
+    return elapsed, distinct
+
+
+def main():
+    run_all = '--all' in sys.argv
+    sizes = [int(arg) for arg in sys.argv[1:] if arg != '--all'] or [1000, 10000, 100000]
+
+    pool = database.get_pool(database_url, max_size=1)
+
+    print("{:>8} {:>22} {:>22}".format("entries", "row by row (s)", "insert_queue (s)"))
+    for size in sizes:
+        filepaths = ["bench/{:08d}.png".format(i) for i in range(size)]
+
+        if run_all or size <= 10000:
+            elapsed, distinct = time_insert(pool, insert_row_by_row, filepaths)
+            row_by_row = "{:.3f} ({} ties)".format(elapsed, size - distinct)
+        else:
+            row_by_row = "skipped"
+
+        elapsed, distinct = time_insert(pool, database.insert_queue, filepaths)
+        bulk = "{:.3f}".format(elapsed)
+
+        print("{:>8} {:>22} {:>22}".format(size, row_by_row, bulk))
+
+    pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
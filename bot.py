@@ -3,12 +3,15 @@
 import tweepy
 import os
 import time
-import random
+import threading
 import datetime
-import psycopg2
 import boto3
 import botocore
-from urllib.parse import urlparse
+import executors
+import listing
+import manifest
+import queues
+import storage
 
 
 class Bot:
@@ -27,19 +30,58 @@ class Bot:
         self.screen_name = bot_keys['screen_name']
         self.access_token = bot_keys['access_token']
         self.access_token_secret = bot_keys['access_token_secret']
-        self.queue_table = bot_keys['queue_table']
-        self.recent_queue_table = bot_keys['recent_queue_table']
-        self.request_sent_table = bot_keys['request_sent_table']
         self.recent_limit = bot_keys['recent_limit']
         self.bucket_name = bot_keys['bucket_name']
         self.bucket_directory = bot_keys['bucket_directory']
         self.max_download_attempts = bot_keys['max_download_attempts']
         self.max_tweet_attempts = bot_keys['max_tweet_attempts']
         self.follower_retrieve_limit = bot_keys['follower_retrieve_limit']
+        self.request_sent_batch_size = bot_keys.get('request_sent_batch_size', 100)
         
-        self.database_url = app_keys['database_url']
         self.tweet_timeout = app_keys['tweet_timeout']
         
+        # Queue, recent queue and request_sent persistence (see storage/)
+        self.storage = storage.create_storage(app_keys, bot_keys)
+        
+        # Bots that share a bucket share its listings (see listing.ListingService).
+        # The manifest registers the bot's folder with the service.
+        self.listing_service = listing.get_service(self.client, app_keys.get('listing_cache_window', 300))
+        
+        # Cached listing of the bucket folder, refreshed incrementally (see manifest.py)
+        self.manifest = manifest.Manifest(self.storage, self.client, self.bucket_name, self.bucket_directory,
+                                          cache_dir=app_keys.get('manifest_cache_dir', 'manifests'),
+                                          marker_key=bot_keys.get('manifest_marker'),
+                                          refresh_interval=app_keys.get('manifest_refresh_interval', 3600),
+                                          full_refresh_interval=app_keys.get('manifest_full_refresh_interval', 86400),
+                                          listing_service=self.listing_service)
+        
+        # "rows" stores one queue row per file, "permutation" stores one state row per bot
+        # and computes the queue from the manifest (see queues.PermutationQueue)
+        self.queue_mode = app_keys.get('queue_mode', 'rows')
+        
+        # "uniform" or "decay" (weights files by how long ago they were last posted, needs
+        # NumPy). Only used by the rows queue mode.
+        self.queue_sampling = app_keys.get('queue_sampling', 'uniform')
+        self.decay_half_life = app_keys.get('decay_half_life', 2592000)
+        
+        # The queue is refilled in the background once it is down to this many files
+        self.queue_low_watermark = bot_keys.get('queue_low_watermark', app_keys.get('queue_low_watermark', 0))
+        self.refill_lock = threading.Lock()
+        
+        # Queue rows are claimed for this many seconds before they are posted, so other
+        # workers skip them (see Storage.claim_queue_row). It must cover the time from
+        # preloading a file to tweeting it.
+        self.worker_id = storage.WORKER_ID
+        self.claim_lease = app_keys.get('claim_lease', 900)
+        
+        # Overlap guards for this bot's scheduled jobs, by job name (see executors.JobGuard)
+        self.guards = {}
+        
+        if self.queue_mode == 'permutation':
+            self.permutation = queues.PermutationQueue(self.storage, self.manifest)
+        else:
+            self.permutation = None
+        
         self.auth = tweepy.OAuthHandler(app_keys['consumer_key'], app_keys['consumer_secret'])
         self.auth.set_access_token(self.access_token, self.access_token_secret)
         self.auth.secure = True
@@ -57,17 +99,16 @@ class Bot:
             filepath = tweet['filepath']
             comment = tweet['comment']
             
-            self.delete_row(self.queue_table, 'filepath', filepath)
+            # Remove the file from the queue and push it into the table of recent tweets
+            # before posting. A missed post is better than a double post.
+            if tweet['permutation']:
+                state = self.permutation.advanced_state()
+                self.storage.commit_tweet(filepath, self.recent_limit, state)
+                self.permutation.commit(state)
+            else:
+                self.storage.commit_tweet(filepath, self.recent_limit)
         
             self.tweet_media(filepath, comment)
-            
-            # Push the tweeted file into the table of recent tweets, and remove the oldest entries
-            # from the table until the limit is reached
-            self.insert_recent(filepath)
-            row_count = self.count_rows(self.recent_queue_table)
-            if row_count > self.recent_limit:
-                for i in range(row_count - self.recent_limit):
-                    self.delete_oldest_row(self.recent_queue_table, 'timestamp')
                 
             
     def download_latest(self):
@@ -77,18 +118,37 @@ class Bot:
         the next filepath in the queue if the file fails to download.
         
         If the download was successful, return the filepath and comment.
+        
+        In permutation mode, rows in the queue table still come first, so files queued
+        by hand with db_utils.py are posted before the rest of the permutation.
+        
+        The file is claimed rather than just read, so another worker (for example an
+        overlapping dyno during a restart) cannot pick the same file.
         """
         for attempt in range(self.max_download_attempts):
-            # Get the latest filepath from the queue, determine destination temp filepath
-            row = self.get_newest_row(self.queue_table)
+            # Claim the latest filepath from the queue, determine destination temp filepath
+            row = self.storage.claim_queue_row(self.worker_id, self.claim_lease)
+            from_permutation = row is None and self.permutation is not None
+            if from_permutation:
+                filepath = self.permutation.claim(self.worker_id, self.claim_lease)
+                row = None if filepath is None else (filepath, None, None)
+            if row is None:
+                break # The queue is empty
+            
             filepath = row[0]
             comment = row[1]
             temp_file = os.path.abspath(filepath)
             dirname = os.path.dirname(temp_file)
             
+            # Rows queued by hand are not checked when the queue is built
+            if not queues.is_postable(filepath):
+                print("{0}: Skipped file {1}, its type cannot be tweeted.".format(self.screen_name, filepath))
+                self.discard_queue_file(filepath, from_permutation)
+                continue
+            
             # Skip downloading if the file already exists locally
             if (os.path.isfile(temp_file)):
-                return {'filepath': filepath, 'comment': comment}
+                return {'filepath': filepath, 'comment': comment, 'permutation': from_permutation}
 
             # Create folder of the destination temp file, otherwise download_file will fail
             # with a FileNotFoundError
@@ -99,22 +159,36 @@ class Bot:
             # the next file in the queue.
             try:
                 self.s3.meta.client.download_file(self.bucket_name, filepath, temp_file)
-                return {'filepath': filepath, 'comment': comment}
+                return {'filepath': filepath, 'comment': comment, 'permutation': from_permutation}
             except FileNotFoundError as error:
                 print("{0}: Could not download file, the destination folder does not exist.".format(self.screen_name))
-                self.delete_row(self.queue_table, 'filepath', filepath)
+                self.discard_queue_file(filepath, from_permutation)
                 continue
             except botocore.exceptions.ClientError as error:
                 print("{0}: Could not download file, the file does not exist in the bucket.".format(self.screen_name))
-                self.delete_row(self.queue_table, 'filepath', filepath)
+                self.discard_queue_file(filepath, from_permutation)
+                if self.permutation is not None:
+                    # Removing a file renumbers the manifest, which would restart the
+                    # permutation, even for a row queued by hand. The permutation skips
+                    # the file instead, until the next full refresh drops it.
+                    self.permutation.drop(filepath)
+                else:
+                    self.manifest.remove(filepath)
                 continue
             except IsADirectoryError as error:
                 print("{0}: There was an error when saving the file (attempted to download a folder instead of a file).".format(self.screen_name))
-                self.delete_row(self.queue_table, 'filepath', filepath)
+                self.discard_queue_file(filepath, from_permutation)
                 break
                 
         return None # If all three attempts fail, just return None
             
+    def discard_queue_file(self, filepath, from_permutation=False):
+        # Removes a file that could not be downloaded from the front of the queue
+        if from_permutation:
+            self.permutation.skip()
+        else:
+            self.storage.delete_queue_file(filepath)
+            
     def tweet_media(self, filepath, comment):
         # Takes an absolute file path to a media file and posts a tweet with the file.
         for attempt in range(self.max_tweet_attempts):
@@ -182,20 +256,34 @@ class Bot:
         protected accounts have one chance to accept, and users who unfollow and follow again will
         not be sent a second follow request. If the table is cleared, users may receive another
         follow request.
+        
+        The whole follower list is checked against the database with one query, and new
+        rows for the request_sent table are written in batches rather than one at a time.
         """
+        # (id, screen_name, timestamp) rows waiting to be written to the request_sent table
+        pending = []
+        
         try:
             # items() returns an iterator object. Copy the items from the iterator
             # into a regular list of followers.
             followers_iterator = tweepy.Cursor(self.api.followers).items(self.follower_retrieve_limit)
             followers = [follower for follower in followers_iterator]
+            
+            already_sent = self.storage.requests_sent([follower.id_str for follower in followers])
 
             # Check if a follow request has already been sent, if not, then send a follow request
             for follower in followers:
-                if not self.request_sent(follower.id_str):
+                if self.cancelled('follow_back'):
+                    break
+                
+                if follower.id_str not in already_sent:
+                    # Never send a second request, even if the follower list has duplicates
+                    already_sent.add(follower.id_str)
+                    
                     try:
                         # Send the follow request
                         follower.follow()
-                        self.update_request_sent(follower.id_str, follower.screen_name)
+                        pending.append((follower.id_str, follower.screen_name, datetime.datetime.now()))
                         print("{0}: Follow request sent to {1}".format(self.screen_name, follower.screen_name))
 
                     except tweepy.error.TweepError as error:
@@ -206,12 +294,17 @@ class Bot:
                                 # user is blocking the account or if the user has been suspended.
                                 #
                                 # Add the user to the table of sent requests to prevent this error from occurring.
-                                self.update_request_sent(follower.id_str, follower.screen_name)
+                                pending.append((follower.id_str, follower.screen_name, datetime.datetime.now()))
                                 print("{0}: Could not follow user {1}. {2}".format(self.screen_name, follower.screen_name, error.reason))
                             elif error.response.status_code == 429:
                                 print("{0}: Could not follow user. Request limit reached.".format(self.screen_name))
                             else:
                                 print("{0}: Could not follow user. Error status code {1}".format(self.screen_name, error.response.status_code))
+                    
+                    # Write out long runs periodically so a crash does not lose them all
+                    if len(pending) >= self.request_sent_batch_size:
+                        self.storage.add_requests_sent(pending)
+                        pending = []
 
         except tweepy.error.TweepError as error:
             if error.response is not None:
@@ -225,13 +318,18 @@ class Bot:
                     print("{0}: Could not follow user. Error status code {1}".format(self.screen_name, error.response.status_code))
             else:
                 print("{0}: Something went very wrong. Reason: {1}".format(self.screen_name, error.reason))
+        
+        finally:
+            if pending:
+                self.storage.add_requests_sent(pending)
 
 
     def unfollow(self):
         """
         Retrieves a list of all friends and all followers, and checks for friends who are no
         longer following. Retrieval is broken into pages of 5000 users at maximum and will
-        wait 60 seconds between pages if there is more than one page.
+        wait 60 seconds between pages if there is more than one page. The wait ends early,
+        and nothing is unfollowed, if the run is cancelled (see cancelled()).
         
         Calls to GET users/lookup are rate limited to 180 requests in a 15 minute interval.
         unfollow() will be called on a timely basis, so it is unlikely the limit will be
@@ -246,26 +344,29 @@ class Bot:
             for page in tweepy.Cursor(self.api.friends_ids).pages():
                 friends.extend(page)
                 
-                if len(page) == 5000:
-                    time.sleep(60)
+                if len(page) == 5000 and self.cancelled('unfollow', 60):
+                    return
                     
             # Grab list of users who follow the account (list of ids)
             followers = []
             for page in tweepy.Cursor(self.api.followers_ids).pages():
                 followers.extend(page)
                 
-                if len(page) == 5000:
-                    time.sleep(60)
+                if len(page) == 5000 and self.cancelled('unfollow', 60):
+                    return
                     
             not_following = 0
             
             # Check relationship status for each user and add them to a list if they are not following
             for friend in friends:
+                if self.cancelled('unfollow'):
+                    break
+                
                 if friend not in followers:
                     try:
                         user = self.api.get_user(friend)
                         user.unfollow()
-                        self.delete_row(self.request_sent_table, 'id', user.id_str)
+                        self.storage.delete_request_sent(user.id_str)
                         print("{0}: Unfollowed {1}".format(self.screen_name, user.screen_name))
                         
                         not_following += 1
@@ -299,260 +400,154 @@ class Bot:
         """
         Randomly adds files to a queue table. However, this algorithm will
         attempt to ensure that the most recently posted files will not appear at the front
-        of the queue. IMPORTANT: "front of the queue" in this instance means the newest files
-        added to the table.
+        of the queue. IMPORTANT: "front of the queue" in this instance means the rows
+        with the lowest ids in the table.
 
         The most recently posted files are kept in a table called [prefix]_recent_queue,
         where [prefix] is the screen_name of a twitter bot. The table length, at maximum,
         should be equal to a user limit defined in keys.json with the key "recent_limit".
 
-        Valid files are drawn from the pool by excluding the recent files. This list is
-        then shuffled, and a certain number (up to recent_limit) of those files are
-        selected to be placed at the start of a list called new queue. The remaining
-        files are mixed with the recent files to form the rest of the list.
+        The file pool comes from the bot's manifest, a cached listing of the bucket
+        folder that is only partially re-listed on each refresh (see manifest.py), and
+        the queue is built by queues.build_queue, or by queues.build_weighted_queue if
+        queue_sampling is "decay" (refer to the comments there for the algorithms).
         
-        When building the new queue, the list is traversed in reverse order to make
-        the aforementioned group of files go at the front of the queue.
-
-        NOTE:
-        Why do we create a temp2 list with the recent files instead of using recent_queue?
-        This is because it is possible for recent_queue to contain files that are no
-        longer in the regular file pool. This method ensures that no dead files are put
-        into the queue.
+        The new queue is written in bulk, in order, so the front of the new queue gets
+        the lowest of the new ids (see database.insert_queue). In permutation mode,
+        nothing but a new seed is written (see queues.PermutationQueue).
+        
+        If the queue still has rows (see refill_queue), the new queue is built from the
+        files that are not queued yet and added behind the current rows in a single
+        transaction, so the tweet path keeps reading the current queue until then.
         """
-        new_queue = []
-
         # Fetch a list of the most recent files posted
-        recent_queue = [row[0] for row in self.get_table_contents(self.recent_queue_table)]
-
-        # Generate a list of files for the next queue
-        response = self.client.list_objects(Bucket=self.bucket_name,Prefix=self.bucket_directory)
-        file_pool = [file['Key'] for file in response['Contents'] if not file['Key'].endswith('/')]
-
-        # Split the files into two groups, shuffle the first group
-        temp = [row for row in file_pool if row not in recent_queue]
-        temp2 = [row for row in file_pool if row in recent_queue] # SEE NOTE IN THE COMMENT ABOVE
-        random.shuffle(temp)
-
-        # Determine how many files to place at the front
-        end = len(temp) if len(temp) < self.recent_limit else self.recent_limit
-        for i in range(end):
-            new_queue.append(temp.pop())
-
-        # Form the rest of the queue, and shuffle again
-        temp = temp + temp2
-        random.shuffle(temp)
-
-        # Finish creating the queue
-        new_queue = new_queue + temp
-
-        # Push the queue to the table
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        for filepath in new_queue[::-1]:
-            timestamp = str(datetime.datetime.now())
-            cur.execute("INSERT INTO {0} (filepath, comment, timestamp) VALUES (%s, %s, %s)".format(self.queue_table), (filepath, None, timestamp))
-
-        conn.commit()
-        cur.close()
-        conn.close()
-        print("File queue {0} shuffled.".format(self.queue_table))
-
-
-    # Counts the number of rows in the table, returns count as an integer
-    def count_rows(self, table_name):
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        cur.execute("SELECT count(*) FROM {}".format(table_name))
-
-        count = cur.fetchone()[0]
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        return count
-
-
-    """
-    Returns the newest row in the table (based on date of insertion)
-    This used to return a single field as a string in previous builds, but will
-    now return the entire row as a tuple.
-    
-    """
-    def get_newest_row(self, table_name):
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        cur.execute("SELECT * FROM {} ORDER BY timestamp DESC LIMIT 1".format(table_name))
-
-        row = cur.fetchone()
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        return row
-
-
-    def delete_oldest_row(self, table_name, fieldname):
-        """
-        Delete oldest row in the table
-
-        Takes table_name and fieldname strings. fieldname is the name of the column
-        in the table called table_name which the function uses to order by date.
-        Therefore, the column should be of an appropriate date type that can be ordered.
-
-        Do not call this function on a table without a date field.
-        """
-        conn = self.create_connection()
-        cur = conn.cursor()
+        recent_queue = self.storage.recent_files()
 
-        cur.execute("""DELETE FROM {0}
-                       WHERE {1}
-                       IN (SELECT {1}
-                           FROM {0}
-                           ORDER BY {1}
-                           ASC
-                           LIMIT 1)""".format(table_name, fieldname))
+        # Bring the cached listing up to date, then use it as the file pool
+        self.manifest.refresh()
 
-        conn.commit()
-        cur.close()
-        conn.close()
-
-
-    # Delete a single row in the table
-    def delete_row(self, table_name, field, id):
-        conn = self.create_connection()
-        cur = conn.cursor()
+        if self.permutation is not None:
+            if self.permutation.build(recent_queue, self.recent_limit) == 0:
+                print("{0}: No files found in {1}/{2}. Queue not created.".format(self.screen_name, self.bucket_name, self.bucket_directory))
+            else:
+                print("{0}: File queue shuffled.".format(self.screen_name))
+            return
 
-        cur.execute("DELETE FROM {0} WHERE {1} = ('{2}')".format(table_name, field, id))
+        # Files that are too large or of a type that cannot be tweeted are never queued
+        postable, skipped = queues.postable_keys(self.manifest.entries())
+        if skipped:
+            print("{0}: {1} files were not queued (unsupported type or too large).".format(self.screen_name, skipped))
+        
+        queued = set(self.storage.queued_files())
+        file_pool = [key for key in postable if key not in queued]
 
-        conn.commit()
-        cur.close()
-        conn.close()
+        if self.queue_sampling == 'decay':
+            new_queue = queues.build_weighted_queue(file_pool, recent_queue, self.recent_limit,
+                                                    self.storage.last_posted_times(), self.decay_half_life)
+        else:
+            new_queue = queues.build_queue(file_pool, recent_queue, self.recent_limit)
 
+        if not new_queue:
+            # Nothing to add if every file is already queued
+            if not queued:
+                print("{0}: No files found in {1}/{2}. Queue not created.".format(self.screen_name, self.bucket_name, self.bucket_directory))
+            return
 
-    def insert_recent(self, entry):
-        """
-        Insert entry into a recent_queue table. Each row should have a path to an file
-        and a timestamp of when the insertion occurred.
+        # Push the queue to the table, behind any rows that are still queued
+        self.storage.push_queue(new_queue, behind=True)
 
-        The timestamp is provided by Python's datetime module.
+        print("{0}: File queue shuffled.".format(self.screen_name))
+        
+    def needs_refill(self, status=None):
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        timestamp = str(datetime.datetime.now())
-
-        cur.execute("INSERT INTO {0} (filepath, timestamp) VALUES ('{1}','{2}')".format(self.recent_queue_table, entry, timestamp))
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-
-    # Helper function for creating a connection to the database
-    def create_connection(self):
-        parsed_url = urlparse(self.database_url)
+        Checks if the queue should be refilled. In rows mode that is when it is down to
+        queue_low_watermark files (keys.json), in permutation mode when it is empty,
+        since a new permutation replaces the current one.
         
-        # Keep trying if the connection failed
-        while True:
-            try:
-                return psycopg2.connect(database=parsed_url.path[1:],
-                                        user=parsed_url.username,
-                                        password=parsed_url.password,
-                                        host=parsed_url.hostname,
-                                        port=parsed_url.port)
-            except psycopg2.OperationalError as error:
-                # This can sometimes occur as "psycopg2.OperationalError: could not translate hostname" error
-                # DNS Error?
-                print("{0}: Could not connect to the database.".format(self.screen_name))
-                
-
-
-    # Check if the given id is in a request_sent table (returns either True or False)
-    def request_sent(self, id):
-        conn = self.create_connection()
-        cur = conn.cursor()
+        If status (this bot's entry from get_fleet_status) is given, the queue count
+        is taken from it instead of querying the database.
+        """
+        count = self.queue_count() if status is None else status['queue_count']
         
-        cur.execute("SELECT id FROM {0} WHERE id = ('{1}')".format(self.request_sent_table, id))
-
-        status = cur.fetchone() is not None
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        return status
-
-
-    # Push the id and screen name of the follower to the list of sent requests
-    def update_request_sent(self, id, screen_name):
-        conn = self.create_connection()
-        cur = conn.cursor()
+        if self.permutation is not None:
+            return count == 0
+        return count <= self.queue_low_watermark
         
-        timestamp = str(datetime.datetime.now())
-
-        cur.execute("INSERT INTO {0} (id, screen_name, timestamp) VALUES ('{1}','{2}','{3}')".format(self.request_sent_table, id, screen_name, timestamp))
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-
-    # Get all rows and columns of a table
-    def get_table_contents(self, table_name):
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        entries = []
-
-        cur.execute("SELECT * FROM {}".format(table_name))
-
-        for row in cur.fetchall():
-            entries.append(row)
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        return entries
-    
-    """
-    Get the timestamp of the most recently added row of the specified table
-    The timestamp is returned as a datetime object!
-    If the query returns None, it means that the recent_queue table is empty.
-    In this case, the epoch time is returned. (1970-01-01 00:00:00)
-    """
-    def get_recent_timestamp(self, table_name):
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        cur.execute("SELECT timestamp FROM {} ORDER BY timestamp DESC LIMIT 1".format(table_name))
-
-        result = cur.fetchone()
+    def refill_queue(self):
+        """
+        Runs smart_queue, unless a refill is already running for this bot or the queue
+        was refilled since this refill was requested. This is meant to run in a
+        background thread, so errors are printed instead of raised.
+        """
+        if not self.refill_lock.acquire(blocking=False):
+            return
         
-        row = datetime.datetime.utcfromtimestamp(0) if result is None else result[0]
+        try:
+            if self.needs_refill():
+                self.smart_queue()
+        except Exception as error:
+            print("{0}: Could not refill the queue. Reason: {1}".format(self.screen_name, error))
+        finally:
+            self.refill_lock.release()
 
-        conn.commit()
-        cur.close()
-        conn.close()
 
-        return row
-        
     # Get the time difference between now and when the most recent tweet was posted
     # Returns the seconds of the timedelta object!
-    def get_time_since_last_tweet(self):
+    # recent_tweet_timestamp can be passed in (e.g. from get_fleet_status) to skip the query
+    def get_time_since_last_tweet(self, recent_tweet_timestamp=None):
         timestamp = datetime.datetime.now()
-        recent_tweet_timestamp = self.get_recent_timestamp(self.recent_queue_table)
+        if recent_tweet_timestamp is None:
+            recent_tweet_timestamp = self.storage.last_tweet_time()
         
         time_difference = timestamp - recent_tweet_timestamp
         
         return time_difference.total_seconds()
         
+    def guard(self, job, policy='skip'):
+        # Returns the executors.JobGuard for one of this bot's jobs, creating it with policy on first use
+        guard = self.guards.get(job)
+        if guard is None:
+            guard = executors.JobGuard("{0}: {1}".format(self.screen_name, job), policy)
+            self.guards[job] = guard
+        return guard
+        
+    def reload(self):
+        """
+        Drop the manifest and permutation queue state held in memory, so they are
+        loaded from the database again. Called when this process takes the bot over
+        from another worker (see imas765probot.rebalance).
+        """
+        self.manifest.reload()
+        if self.permutation is not None:
+            self.permutation.reload()
+        
+    def busy(self):
+        # True if any of this bot's guarded jobs is waiting or running
+        return any(guard.busy for guard in self.guards.values())
+        
+    def cancelled(self, job, timeout=None):
+        """
+        Checks if the running job was asked to stop by the cancel overrun policy (see
+        executors.JobGuard). If timeout is given, waits up to timeout seconds for that
+        instead, so long jobs use this in place of time.sleep.
+        """
+        guard = self.guards.get(job)
+        if guard is None:
+            if timeout:
+                time.sleep(timeout)
+            return False
+        
+        if timeout:
+            return guard.wait(timeout)
+        return guard.cancelled
+        
+    def queue_count(self):
+        # Returns the number of files left in the queue, in either queue mode
+        count = self.storage.queue_count()
+        if self.permutation is not None:
+            count += self.permutation.remaining()
+        return count
+        
     """
     Checks if the bot is allowed to tweet
     
@@ -561,6 +556,34 @@ class Bot:
     3. A certain amount of time must have passed since the last tweet
        (defined as tweet_timeout in keys.json)
     
+    If status (this bot's entry from get_fleet_status) is given, the queue count
+    and last tweet time are taken from it instead of querying the database.
+    """
+    def can_tweet(self, status=None):
+        if status is None:
+            return self.tweet_enabled and self.queue_count() > 0 and self.get_time_since_last_tweet() > self.tweet_timeout
+
+        return self.tweet_enabled and status['queue_count'] > 0 and self.get_time_since_last_tweet(status['last_tweet']) > self.tweet_timeout
+
+
+def get_fleet_status(bots):
+    """
+    Returns a snapshot of every bot's queue depth and last tweet time, fetched with a
+    single query instead of separate queue_count and last_tweet_time calls for each
+    bot. All bots must use the same storage backend.
+
+    The result is a dictionary keyed by screen_name. Each value is a dictionary with
+    the keys queue_count (integer) and last_tweet (datetime object, or the epoch time
+    if the bot has never tweeted).
     """
-    def can_tweet(self):
-        return self.tweet_enabled and self.count_rows(self.queue_table) > 0 and self.get_time_since_last_tweet() > self.tweet_timeout
\ No newline at end of file
+    if not bots:
+        return {}
+
+    status = type(bots[0].storage).fleet_status([bot.storage for bot in bots])
+
+    # Permutation queues have no rows to count, their length is kept in memory
+    for bot in bots:
+        if bot.permutation is not None:
+            status[bot.screen_name]['queue_count'] += bot.permutation.remaining()
+
+    return status
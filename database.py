@@ -0,0 +1,582 @@
+# Shared PostgreSQL connection pool
+
+import re
+import math
+import zlib
+import select
+import hashlib
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+
+# Channel the queue triggers notify on (see utils/db_utils.py, version 8)
+NOTIFY_CHANNEL = 'queue_changes'
+
+# First key of the advisory locks used to shard bots between workers (see ShardLeases)
+SHARD_BOT_LOCK = 765001
+SHARD_WORKER_LOCK = 765002
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out of the pool in time."""
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers which server-side prepared statements have
+    been created on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        psycopg2.extensions.connection.__init__(self, *args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """
+    Thread-safe, bounded pool of psycopg2 connections.
+
+    Connections are opened lazily up to max_size. When every connection is in use,
+    callers wait (up to timeout seconds) for one to be returned instead of opening
+    a new one. Connections are checked before they are handed out: closed or broken
+    connections are discarded, and connections that have been idle for longer than
+    health_check_interval seconds are pinged with a SELECT 1 first.
+
+    Use cursor() as a context manager. It commits when the block finishes, rolls
+    back if the block raises, and always returns the connection to the pool.
+
+    Frequently run queries should go through execute(), which prepares them once per
+    connection and keeps per-statement execution counts and times. Set prepare to
+    False when connecting through a transaction-pooling proxy such as PgBouncer, which
+    does not support server-side prepared statements.
+    """
+
+    def __init__(self, database_url, max_size=10, timeout=30, health_check_interval=30, prepare=True):
+        self.parsed_url = urlparse(database_url)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.prepare = prepare
+
+        self._condition = threading.Condition(threading.Lock())
+        self._idle = []   # (connection, time it was returned) pairs, most recent last
+        self._size = 0    # Number of open connections, idle or checked out
+
+        self._counters = {'checkouts': 0,
+                          'waits': 0,
+                          'timeouts': 0,
+                          'connects': 0,
+                          'health_checks': 0,
+                          'discarded': 0}
+
+        # Statement name -> {'calls', 'prepares', 'total_time'}
+        self._statements = {}
+
+    def _connect(self):
+        # Keep trying if the connection failed
+        while True:
+            try:
+                conn = psycopg2.connect(database=self.parsed_url.path[1:],
+                                        user=self.parsed_url.username,
+                                        password=self.parsed_url.password,
+                                        host=self.parsed_url.hostname,
+                                        port=self.parsed_url.port,
+                                        connection_factory=PooledConnection)
+                with self._condition:
+                    self._counters['connects'] += 1
+                return conn
+            except psycopg2.OperationalError as error:
+                # This can sometimes occur as "psycopg2.OperationalError: could not translate hostname" error
+                # DNS Error?
+                print("Could not connect to the database. Retrying.")
+                time.sleep(1)
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+
+        # Only ping connections that have been sitting in the pool for a while,
+        # otherwise every query would cost an extra round trip
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        with self._condition:
+            self._counters['health_checks'] += 1
+
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        with self._condition:
+            self._size -= 1
+            self._counters['discarded'] += 1
+            self._condition.notify()
+
+    def getconn(self):
+        """
+        Check a connection out of the pool. The caller must hand it back with putconn().
+        """
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            conn = None
+            idle_since = None
+
+            with self._condition:
+                waited = False
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout("No database connection became available within {} seconds.".format(self.timeout))
+                    if not waited:
+                        self._counters['waits'] += 1
+                        waited = True
+                    self._condition.wait(remaining)
+
+                self._counters['checkouts'] += 1
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    self._size += 1 # Reserve a slot for the new connection
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+
+            if self._is_healthy(conn, idle_since):
+                return conn
+
+            # Broken connection, throw it away and try again
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool. Connections in a failed or unfinished
+        transaction are rolled back, and discarded if that is not possible.
+        """
+        if close or conn.closed:
+            self._discard(conn)
+            return
+
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks out a connection and returns it to the pool
+        afterwards. The caller is responsible for committing.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            # The connection itself is most likely unusable
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Context manager that yields a cursor on a pooled connection. The transaction
+        is committed when the block exits normally and rolled back otherwise.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                    self._reset_prepared(conn)
+                raise
+            finally:
+                cur.close()
+
+    def _reset_prepared(self, conn):
+        # After a failed transaction we cannot be sure which PREPAREs took effect (a
+        # PREPARE survives the rollback, even if the EXECUTE sent with it failed and
+        # it was never recorded in conn.prepared), so start over on this connection
+        if not self.prepare:
+            return
+
+        conn.prepared.clear()
+        try:
+            cur = conn.cursor()
+            cur.execute("DEALLOCATE ALL")
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            # The pool discards closed connections when they are returned
+            conn.close()
+
+    def execute(self, cur, name, sql, params=()):
+        """
+        Run sql on cur as the prepared statement called name. sql uses PostgreSQL's
+        positional parameters ($1, $2, ...) and params is the sequence of values.
+
+        The first time a connection runs a statement, the PREPARE is sent in the same
+        round trip as the EXECUTE. After that only the statement name and the values
+        are sent, and the server reuses the parsed statement and its plan.
+        """
+        params = list(params)
+        conn = cur.connection
+
+        start = time.perf_counter()
+
+        if not self.prepare:
+            # Same statement, sent as plain SQL with client-side parameters
+            cur.execute(_POSITIONAL_PARAMETER.sub(r'%(p\1)s', sql.replace('%', '%%')),
+                        {'p{}'.format(index + 1): value for index, value in enumerate(params)})
+            prepared = False
+        else:
+            execute = "EXECUTE {0} ({1})".format(name, ", ".join(["%s"] * len(params))) if params else "EXECUTE {}".format(name)
+
+            prepared = name not in conn.prepared
+            if prepared:
+                cur.execute("PREPARE {0} AS {1}; {2}".format(name, sql.replace('%', '%%'), execute), params)
+                conn.prepared.add(name)
+            else:
+                cur.execute(execute, params)
+
+        elapsed = time.perf_counter() - start
+
+        with self._condition:
+            stats = self._statements.setdefault(name, {'calls': 0, 'prepares': 0, 'total_time': 0.0})
+            stats['calls'] += 1
+            stats['prepares'] += 1 if prepared else 0
+            stats['total_time'] += elapsed
+
+    def statement_stats(self):
+        """
+        Returns a dictionary keyed by statement name. Each value is a dictionary with the
+        number of calls, the number of times the statement was prepared (once per
+        connection), and the total and mean execution time in seconds as seen by the
+        client, including the round trip.
+        """
+        with self._condition:
+            return {name: dict(stats, mean_time=stats['total_time'] / stats['calls'])
+                    for name, stats in self._statements.items()}
+
+    def stats(self):
+        """
+        Returns a dictionary with the current pool size, idle and in-use connection
+        counts, and running totals of checkouts, waits, timeouts, new connections,
+        health checks and discarded connections.
+        """
+        with self._condition:
+            stats = dict(self._counters)
+            stats['max_size'] = self.max_size
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            return stats
+
+    def closeall(self):
+        # Close every idle connection. Checked out connections are closed when they are returned.
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+
+        for conn, idle_since in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+
+_POSITIONAL_PARAMETER = re.compile(r'\$(\d+)')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_url, max_size=10, timeout=30, prepare=True):
+    """
+    Returns the process-wide pool for database_url, creating it on first use. Every
+    Bot (and every executor thread) that uses the same database shares one pool.
+    """
+    with _pools_lock:
+        pool = _pools.get(database_url)
+        if pool is None:
+            pool = ConnectionPool(database_url, max_size=max_size, timeout=timeout, prepare=prepare)
+            _pools[database_url] = pool
+        return pool
+
+
+def statement_name(kind, *tables):
+    """
+    Returns a prepared statement name for a query of the given kind on the given
+    tables. Each table gets its own statement, and the name always fits within
+    PostgreSQL's 63 character identifier limit.
+    """
+    digest = hashlib.md5(",".join(tables).encode('utf-8')).hexdigest()[:12]
+    return "{0}_{1}".format(kind[:48], digest)
+
+
+class Listener:
+    """
+    A dedicated connection (outside the pool, since it is never returned) that LISTENs
+    on channel and passes the payload of each notification to callback, on a
+    background thread.
+
+    on_connect is called every time the connection is (re)established, after LISTEN,
+    so the caller can reload anything it missed while disconnected. It is called
+    again every resync_interval seconds as a safety net. connected is True while the
+    connection is up and on_connect has completed.
+    """
+
+    def __init__(self, database_url, channel, callback, on_connect=None, resync_interval=3600, retry_interval=5):
+        self.parsed_url = urlparse(database_url)
+        self.channel = channel
+        self.callback = callback
+        self.on_connect = on_connect
+        self.resync_interval = resync_interval
+        self.retry_interval = retry_interval
+
+        self.connected = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='listener-' + self.channel, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _resync(self):
+        if self.on_connect is not None:
+            self.on_connect()
+        self.connected = True
+        return time.monotonic()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(database=self.parsed_url.path[1:],
+                                        user=self.parsed_url.username,
+                                        password=self.parsed_url.password,
+                                        host=self.parsed_url.hostname,
+                                        port=self.parsed_url.port)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN {}".format(self.channel))
+
+                synced = self._resync()
+
+                while not self._stopped.is_set():
+                    # Wake up at least every few seconds to check for stop() and the resync
+                    if select.select([conn], [], [], 5) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self.callback(conn.notifies.pop(0).payload)
+
+                    if time.monotonic() - synced >= self.resync_interval:
+                        synced = self._resync()
+            except Exception as error:
+                print("Lost the connection listening on {0}, retrying. Reason: {1}".format(self.channel, error))
+                self.connected = False
+                self._stopped.wait(self.retry_interval)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+
+
+class ShardLeases:
+    """
+    Splits a fleet of bots between worker processes (or dynos) with session-level
+    advisory locks on a dedicated connection. A worker owns a bot while it holds the
+    lock (SHARD_BOT_LOCK, key of the bot's screen_name). Each worker also holds
+    (SHARD_WORKER_LOCK, its backend pid), so the live workers can be counted from
+    pg_locks without a table of their own.
+
+    The locks are leases that renew themselves while the connection is up: when a
+    worker dies or its connection drops, the server releases every lock it held,
+    and other workers can claim its bots. The connection sets the server's TCP
+    keepalive settings for its session, so the server drops the connection of a
+    worker that vanished without closing it (and releases its locks) after about a
+    minute, instead of after the server's default of up to two hours. The client
+    keepalives only let the worker notice a dead server. A restarting dyno cannot
+    claim a bot until the old process has exited, so a bot is never run by two
+    workers at once.
+
+    rebalance() is called periodically. It checks the connection (reconnecting and
+    starting over with no bots if it was lost), then aims for an even share of
+    ceil(bots / workers): surplus bots are released, except those in busy (bots
+    with jobs still running, released on a later call), and unowned bots are
+    claimed until the share is reached.
+    """
+
+    def __init__(self, database_url, connect_timeout=10):
+        self.parsed_url = urlparse(database_url)
+        self.connect_timeout = connect_timeout
+
+        self._conn = None
+        self._owned = []
+
+    @staticmethod
+    def bot_key(screen_name):
+        # Stable across processes (unlike hash()), and fits a non-negative int4
+        return zlib.crc32(screen_name.encode('utf-8')) & 0x7fffffff
+
+    def _connect(self):
+        conn = psycopg2.connect(database=self.parsed_url.path[1:],
+                                user=self.parsed_url.username,
+                                password=self.parsed_url.password,
+                                host=self.parsed_url.hostname,
+                                port=self.parsed_url.port,
+                                connect_timeout=self.connect_timeout,
+                                keepalives=1,
+                                keepalives_idle=30,
+                                keepalives_interval=10,
+                                keepalives_count=3,
+                                options='-c tcp_keepalives_idle=30 -c tcp_keepalives_interval=10 '
+                                        '-c tcp_keepalives_count=3')
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s, pg_backend_pid())", (SHARD_WORKER_LOCK,))
+        return conn
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+        self._owned = []
+
+    def _live_workers(self, cur):
+        cur.execute("SELECT count(*) FROM pg_locks "
+                    "WHERE locktype = 'advisory' AND granted AND objsubid = 2 AND classid = %s "
+                    "AND database = (SELECT oid FROM pg_database WHERE datname = current_database())",
+                    (SHARD_WORKER_LOCK,))
+        return max(cur.fetchone()[0], 1)
+
+    def rebalance(self, screen_names, busy=()):
+        """
+        Rebalances (see the class comments) and returns the screen_names this worker
+        now owns, in the order of screen_names.
+        """
+        try:
+            if self._conn is None:
+                self._conn = self._connect()
+
+            with self._conn.cursor() as cur:
+                share = math.ceil(len(screen_names) / self._live_workers(cur))
+
+                # Release the surplus, last claimed first
+                for name in reversed(list(self._owned)):
+                    if len(self._owned) <= share:
+                        break
+                    if name not in busy:
+                        cur.execute("SELECT pg_advisory_unlock(%s, %s)", (SHARD_BOT_LOCK, self.bot_key(name)))
+                        self._owned.remove(name)
+
+                for name in screen_names:
+                    if len(self._owned) >= share:
+                        break
+                    if name in self._owned:
+                        continue
+                    cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (SHARD_BOT_LOCK, self.bot_key(name)))
+                    if cur.fetchone()[0]:
+                        self._owned.append(name)
+        except psycopg2.Error as error:
+            # The server released every lock of the lost session, so this worker owns nothing
+            print("Lost the shard lease connection, releasing every bot. Reason: {0}".format(error))
+            self._disconnect()
+
+        return [name for name in screen_names if name in self._owned]
+
+    def close(self):
+        # Releases every bot and leaves the fleet
+        self._disconnect()
+
+
+def insert_queue(cur, table_name, bot, filepaths, comment=None, page_size=1000, front=False):
+    """
+    Bulk insert filepaths into bot's queue with batched multi-row INSERT statements
+    (page_size rows per statement) on the given cursor.
+
+    Queue rows are ordered by their id, lowest id first (see
+    Storage.claim_queue_row), not by their timestamp, which is only the time they
+    were queued. filepaths should be ordered front of the queue first. By default
+    the rows are inserted in that order and take their ids from the table's
+    sequence, so they go behind every row already queued, and rows inserted by
+    several writers at once never tie or interleave within a batch.
+
+    If front is True, the rows go in front of every queued row instead: they are
+    given the ids just below the lowest id in the table. The table is locked
+    against other inserts until the transaction ends, so two writers cannot pick
+    the same ids.
+    """
+    filepaths = list(filepaths)
+    timestamp = datetime.datetime.now()
+
+    if not front:
+        rows = ((bot, filepath, comment, timestamp) for filepath in filepaths)
+        psycopg2.extras.execute_values(cur,
+                                       "INSERT INTO {0} (bot, filepath, comment, timestamp) VALUES %s".format(table_name),
+                                       rows,
+                                       page_size=page_size)
+        return
+
+    cur.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(table_name))
+    cur.execute("SELECT coalesce(min(id), 1) FROM {}".format(table_name))
+    first = cur.fetchone()[0] - len(filepaths)
+
+    rows = ((first + position, bot, filepath, comment, timestamp) for position, filepath in enumerate(filepaths))
+    psycopg2.extras.execute_values(cur,
+                                   "INSERT INTO {0} (id, bot, filepath, comment, timestamp) VALUES %s".format(table_name),
+                                   rows,
+                                   page_size=page_size)
@@ -0,0 +1,242 @@
+# Long-lived worker pools for the scheduler's jobs
+
+import threading
+import concurrent.futures
+
+
+# Job classes and their default number of workers. tweet has one worker per bot.
+EXECUTOR_WORKERS = {'tweet': 12,
+                    'follow': 4,
+                    'maintenance': 4,
+                    'prefetch': 4}
+
+# What to do when a job is dispatched while its previous run is still going (see JobGuard)
+OVERRUN_POLICIES = ('skip', 'queue', 'cancel')
+
+
+class BoundedExecutor:
+    """
+    A ThreadPoolExecutor that is created once and kept for the life of the process,
+    with a fixed number of workers and at most max_queued tasks waiting for one.
+
+    submit() never blocks. A task that does not fit is rejected and submit() returns
+    None instead of a future, so a backlog in one job class cannot grow without
+    bound or hold up the scheduler.
+
+    stats() returns the queue depth (tasks waiting for a worker), the number of
+    running tasks, the deepest the queue has been, and running totals of submitted,
+    completed, failed, rejected and cancelled tasks.
+    """
+
+    def __init__(self, name, workers, max_queued=100):
+        self.name = name
+        self.workers = workers
+        self.max_queued = max_queued
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queued)
+        self._lock = threading.Lock()
+        self._pending = 0 # Submitted and not finished, waiting or running
+        self._counters = {'running': 0,
+                          'max_queued': 0,
+                          'submitted': 0,
+                          'completed': 0,
+                          'failed': 0,
+                          'rejected': 0,
+                          'cancelled': 0}
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters['rejected'] += 1
+            print("Executor {0} is full ({1} queued), task rejected.".format(self.name, self.max_queued))
+            return None
+
+        with self._lock:
+            self._counters['submitted'] += 1
+            self._pending += 1
+            queued = self._pending - self._counters['running']
+            self._counters['max_queued'] = max(self._counters['max_queued'], queued)
+
+        try:
+            future = self._executor.submit(self._run, fn, args, kwargs)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+            raise
+
+        # The slot is given back when the future is done, which also covers futures
+        # cancelled before they started (see JobGuard.dispatch)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled():
+                self._counters['cancelled'] += 1
+        self._slots.release()
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._counters['running'] += 1
+
+        try:
+            return fn(*args, **kwargs)
+        except Exception as error:
+            with self._lock:
+                self._counters['failed'] += 1
+            print("Task failed in executor {0}. Reason: {1}".format(self.name, error))
+            raise
+        finally:
+            with self._lock:
+                self._counters['running'] -= 1
+                self._counters['completed'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['queued'] = self._pending - self._counters['running']
+        stats['workers'] = self.workers
+        return stats
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def create_executors(app_keys):
+    """
+    Creates one BoundedExecutor per job class in EXECUTOR_WORKERS. The sizes can be
+    changed with "executor_workers" in keys.json, and "executor_queue_limit" sets how
+    many tasks each may have waiting.
+    """
+    workers = dict(EXECUTOR_WORKERS, **app_keys.get('executor_workers', {}))
+    max_queued = app_keys.get('executor_queue_limit', 100)
+
+    return {name: BoundedExecutor(name, size, max_queued) for name, size in workers.items()}
+
+
+class _Run:
+    # One dispatched run of a guarded job. handle is its future (or task).
+    __slots__ = ('started', 'handle')
+
+    def __init__(self):
+        self.started = False
+        self.handle = None
+
+
+class BaseJobGuard:
+    """
+    Keeps one job (for example one bot's unfollow) from overlapping with itself.
+    dispatch() starts the job and returns at once, unless a run of the job is
+    already waiting or running. In that case the overrun policy decides:
+
+    skip:   the new run is dropped
+    queue:  the new run starts when the current one finishes (if the job overruns
+            several times, the waiting runs are merged into one)
+    cancel: the current run is asked to stop, and the new run starts when it has.
+            A run that has not started yet is cancelled outright. Stopping is
+            cooperative: long jobs check cancelled, or wait() instead of sleeping.
+
+    This class holds the policy and the bookkeeping. Subclasses implement _submit,
+    which hands a run to their executor (see JobGuard, and AsyncJobGuard in
+    asyncio_runtime.py), and call _finish when a run is over.
+    """
+
+    def __init__(self, name, policy='skip'):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy \"{0}\" for {1}.".format(policy, name))
+
+        self.name = name
+        self.policy = policy
+
+        self._lock = threading.Lock()
+        self._current = None # The _Run that is waiting or running
+        self._pending = None # (executor, fn) to run when it finishes
+        self._cancel = threading.Event()
+
+    def dispatch(self, executor, fn):
+        # Returns True if the job was submitted or will run after the current run
+        with self._lock:
+            if self._current is not None and self.policy == 'cancel' and not self._current.started:
+                # Not started yet: drop it, and _call will not run it if it gets a worker
+                self._current.handle.cancel()
+                self._current = None
+
+            if self._current is None:
+                return self._start(executor, fn)
+
+            if self.policy == 'skip':
+                print("{0} is still running, the new run was skipped.".format(self.name))
+                return False
+
+            if self.policy == 'cancel':
+                print("{0} is still running, asking it to stop.".format(self.name))
+                self._cancel.set()
+
+            self._pending = (executor, fn)
+            return True
+
+    def _start(self, executor, fn):
+        # Called with the lock held, so the run cannot start before _current is set
+        self._cancel.clear()
+        run = _Run()
+        self._current = run
+        run.handle = self._submit(executor, run, fn)
+        if run.handle is None:
+            self._current = None
+            return False
+        return True
+
+    def _submit(self, executor, run, fn):
+        # Hands _call(run, fn) to executor, returns its future (or task), or None if it was rejected
+        raise NotImplementedError
+
+    def _call(self, run, fn):
+        # Runs fn on a worker thread, unless run was cancelled before it got there
+        with self._lock:
+            if run is not self._current:
+                return None
+            run.started = True
+        return fn()
+
+    def _finish(self, run):
+        # Starts the pending run, if any, once run is over
+        with self._lock:
+            if run is not self._current:
+                return # Cancelled before it started, and already replaced
+            self._current = None
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                self._start(*pending)
+
+    @property
+    def busy(self):
+        # True if a run is waiting or running
+        return self._current is not None
+
+    @property
+    def cancelled(self):
+        # True if the current run has been asked to stop
+        return self._cancel.is_set()
+
+    def wait(self, timeout):
+        # Sleeps for up to timeout seconds, returns True early if the current run is asked to stop
+        return self._cancel.wait(timeout)
+
+
+class JobGuard(BaseJobGuard):
+    """
+    A BaseJobGuard whose runs are submitted to a BoundedExecutor, or any
+    concurrent.futures executor.
+    """
+
+    def _submit(self, executor, run, fn):
+        return executor.submit(self._run, run, fn)
+
+    def _run(self, run, fn):
+        try:
+            return self._call(run, fn)
+        finally:
+            self._finish(run)
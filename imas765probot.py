@@ -2,10 +2,14 @@
 
 import json
 import time
+import asyncio
 import datetime
+import functools
 from random import sample
-import concurrent.futures
-from bot import Bot
+import executors
+import asyncio_runtime
+from bot import Bot, get_fleet_status
+from scheduler import Scheduler, Job
 
 
 # Load key data from keys.json, create Bot objects for each bot
@@ -17,18 +21,22 @@ with open('keys.json') as key_data:
     app_enabled = app_keys['enabled']
     shuffle_mode = app_keys['shuffle_mode']
     
-    bots = [Bot(app_keys, key_dict['makomakorin_bot']),
-            Bot(app_keys, key_dict['harurun_bot_']),
-            Bot(app_keys, key_dict['chihaya_bot_']),
-            Bot(app_keys, key_dict['yayoicchi_bot']),
-            Bot(app_keys, key_dict['iorin_bot_']),
-            Bot(app_keys, key_dict['amimami_bot']),
-            Bot(app_keys, key_dict['yukipyon_bot']),
-            Bot(app_keys, key_dict['ohimechin_bot']),
-            Bot(app_keys, key_dict['mikimiki_bot_']),
-            Bot(app_keys, key_dict['hibikin_bot_']),
-            Bot(app_keys, key_dict['azusa_bot__']),
-            Bot(app_keys, key_dict['ricchan_bot_'])]
+    fleet = [Bot(app_keys, key_dict['makomakorin_bot']),
+             Bot(app_keys, key_dict['harurun_bot_']),
+             Bot(app_keys, key_dict['chihaya_bot_']),
+             Bot(app_keys, key_dict['yayoicchi_bot']),
+             Bot(app_keys, key_dict['iorin_bot_']),
+             Bot(app_keys, key_dict['amimami_bot']),
+             Bot(app_keys, key_dict['yukipyon_bot']),
+             Bot(app_keys, key_dict['ohimechin_bot']),
+             Bot(app_keys, key_dict['mikimiki_bot_']),
+             Bot(app_keys, key_dict['hibikin_bot_']),
+             Bot(app_keys, key_dict['azusa_bot__']),
+             Bot(app_keys, key_dict['ricchan_bot_'])]
+    
+    # The bots this process runs: the whole fleet, or this worker's share of it if
+    # "sharding" is enabled in keys.json (see rebalance)
+    bots = list(fleet)
 
             
 """
@@ -42,75 +50,346 @@ GET friends/list        friends                 15
 GET friendships/show    friendships             180                             15
 """
 
+# The fleet status of the current scheduler tick (see tick_status)
+_tick = {'minute': None, 'status': None}
+
+
+def tick_status():
+    """
+    Returns the queue depth and last tweet time of every bot (see get_fleet_status),
+    fetched once per scheduler tick: the first job of a minute runs the query and
+    the other jobs of that minute reuse it, so tweet and refill decide from the same
+    snapshot.
+    """
+    minute = int(time.time() // 60)
+    if _tick['minute'] != minute:
+        _tick['status'] = get_fleet_status(bots)
+        _tick['minute'] = minute
+    return _tick['status']
+
+
+def tick_status_async(offloader):
+    # tick_status() for the asyncio runtime: returns a future of the status, fetched off the event loop
+    minute = int(time.time() // 60)
+    if _tick['minute'] != minute:
+        _tick['status'] = asyncio.ensure_future(offloader.run(get_fleet_status, list(bots)))
+        _tick['minute'] = minute
+    return _tick['status']
+
+
+# The hour in which each bot's tweet was last dispatched (see dispatch_tweet)
+_tweet_hours = {}
+
+
+def dispatch_tweet(executor, bot, bot_status):
+    # Tweet for bot if it can tweet, at most once an hour, so a catch up (see catch_up_tweets) and the tweet job never both post
+    hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    if _tweet_hours.get(bot.screen_name) != hour and bot.can_tweet(bot_status):
+        if bot.guard('tweet').dispatch(executor, bot.tweet):
+            _tweet_hours[bot.screen_name] = hour
+
+
+def tweet(executor, status=None):
+    """
+    Tweet a new media file (every hour at minute 0)
+    Certain conditions must be satisfied before tweeting, refer to the comments
+    for can_tweet() in bot.py
+    
+    The order the bots tweet in is shuffled every hour. I use a random sample of
+    the indices for the bot list to simulate a shuffle. This is done instead of
+    using random.shuffle on the bot list because random.shuffle performs an in place
+    shuffle that changes the order of bots in the list. This way, tweets can be in a
+    random order without affecting follow back or unfollow order.
+    """
+    # Queue depth and last tweet time for every bot, shared with the other jobs of this tick
+    if status is None:
+        status = tick_status()
+    
+    # Bots claimed after the status was fetched wait for the next run (see rebalance)
+    active = [bot for bot in bots if bot.screen_name in status]
+    
+    if shuffle_mode:
+        for index in sample(range(len(active)),len(active)):
+            dispatch_tweet(executor, active[index], status[active[index].screen_name])
+    else:
+        for bot in active:
+            dispatch_tweet(executor, bot, status[bot.screen_name])
+
+
+def follow_back(executor):
+    # Follow back users (every 30 minutes at minute 15 and 45)
+    for bot in bots:
+        if bot.follow_back_enabled:
+            bot.guard('follow_back').dispatch(executor, bot.follow_back)
+
+
+def unfollow(executor):
+    # Unfollow users who are no longer following (every hour at minute 30)
+    for bot in bots:
+        if bot.unfollow_enabled:
+            bot.guard('unfollow').dispatch(executor, bot.unfollow)
+
+
+def preload(executor):
+    # Preload files in advance if enabled (every hour at minute 55)
+    for bot in bots:
+        if bot.preload:
+            bot.guard('preload').dispatch(executor, bot.download_latest)
+
+
+def refill(executor, status=None):
+    # If a queue is running low, refill it in the background (every minute)
+    if status is None:
+        status = tick_status()
+    
+    for bot in bots:
+        if bot.screen_name in status and bot.needs_refill(status[bot.screen_name]):
+            bot.guard('refill').dispatch(executor, bot.refill_queue)
+
+
+async def tweet_async(offloaders):
+    # tweet() for the asyncio runtime, with the fleet status fetched off the event loop
+    status = await tick_status_async(offloaders['tweet'])
+    if status is None:
+        return
+    tweet(offloaders['tweet'], status)
+
+
+async def refill_async(offloaders):
+    # refill() for the asyncio runtime, with the fleet status fetched off the event loop
+    status = await tick_status_async(offloaders['tweet'])
+    if status is None:
+        return
+    refill(offloaders['maintenance'], status)
+
+
+def apply_leases(owned):
+    """
+    Update the bots this worker runs to owned (screen_names, see
+    database.ShardLeases.rebalance), and return the bots that were just taken over.
+    Their manifest and queue state is reloaded from the database, since the worker
+    that ran them before may have changed it.
+    """
+    if owned == [bot.screen_name for bot in bots]:
+        return []
+    
+    acquired = [bot for bot in fleet if bot.screen_name in owned and bot not in bots]
+    bots[:] = [bot for bot in fleet if bot.screen_name in owned]
+    _tick['minute'] = None # The status of this tick does not cover the new bots
+    print("Running {0} of {1} bots: {2}".format(len(bots), len(fleet), ", ".join(owned)))
+    
+    for bot in acquired:
+        bot.reload()
+    return acquired
+
+
+def catch_up_tweets(executor, acquired, status):
+    """
+    Tweet for bots this worker just took over that have not tweeted since the start
+    of the hour. A bot can change worker around minute 0, after the new worker's
+    tweet job has run, or be released by a worker that did not get to tweet for it;
+    without this it would skip the hour. can_tweet still enforces tweet_timeout.
+    """
+    hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    for bot in acquired:
+        if status[bot.screen_name]['last_tweet'] < hour:
+            dispatch_tweet(executor, bot, status[bot.screen_name])
+
+
+def rebalance(leases, executor):
+    """
+    Rebalance the leases and run the bots this worker now holds (every minute,
+    before the other jobs). Bots with jobs still running are only released once the
+    jobs finish.
+    """
+    owned = leases.rebalance([bot.screen_name for bot in fleet],
+                             {bot.screen_name for bot in fleet if bot.busy()})
+    
+    acquired = apply_leases(owned)
+    if acquired:
+        catch_up_tweets(executor, acquired, get_fleet_status(acquired))
+
+
+async def rebalance_async(leases, offloaders):
+    # rebalance() for the asyncio runtime, with the leases and the status handled off the event loop
+    owned = await offloaders['maintenance'].run(leases.rebalance,
+                                                [bot.screen_name for bot in fleet],
+                                                {bot.screen_name for bot in fleet if bot.busy()})
+    if owned is None:
+        return
+    
+    acquired = apply_leases(owned)
+    if acquired:
+        status = await offloaders['tweet'].run(get_fleet_status, acquired)
+        if status is not None:
+            catch_up_tweets(offloaders['tweet'], acquired, status)
+
+
+def print_executor_stats(pools):
+    # Print the queue depth and task counts of every worker pool (every hour at minute 59)
+    for name, pool in sorted(pools.items()):
+        stats = pool.stats()
+        print("Executor {0}: {1} queued (max {2}), {3} running, {4} completed, {5} failed, {6} rejected, {7} cancelled.".format(
+              name, stats['queued'], stats['max_queued'], stats['running'], stats['completed'], stats['failed'], stats['rejected'], stats['cancelled']))
+
+
+def print_database_stats(pool):
+    # Print the connection pool counters and the calls and time of every prepared statement (every hour at minute 59)
+    stats = pool.stats()
+    print("Database pool: {0} of {1} connections, {2} in use, {3} checkouts, {4} waits, {5} timeouts, {6} discarded.".format(
+          stats['size'], stats['max_size'], stats['in_use'], stats['checkouts'], stats['waits'], stats['timeouts'], stats['discarded']))
+    
+    # Slowest statements (by total time) first
+    statements = sorted(pool.statement_stats().items(), key=lambda item: item[1]['total_time'], reverse=True)
+    for name, stats in statements:
+        print("Statement {0}: {1} calls, {2} prepares, {3:.3f} s total, {4:.2f} ms mean.".format(
+              name, stats['calls'], stats['prepares'], stats['total_time'], stats['mean_time'] * 1000))
+
+
+"""
+SCHEDULE
+
+Jobs run on the dot at the minutes of the hour below (see scheduler.py). If the
+scheduler falls behind (for example because a job ran long), each job's catch up
+policy decides what happens to the runs it missed: "skip" drops them, "once" runs
+the job once, "all" runs it once per missed run. The policies can be changed with
+"catch_up" in keys.json.
+
+Each job hands its work to the long-lived worker pool of its class (see
+executors.py) and returns without waiting for it, so a slow job never holds up
+the jobs after it. The pool sizes can be changed with "executor_workers" in
+keys.json.
+
+A bot never runs two copies of the same job at once. If a job is due while the
+bot's previous run of it is still going, the job's overrun policy decides: "skip"
+drops the new run, "queue" runs it when the previous run finishes, "cancel" asks
+the previous run to stop and then runs the new one (see executors.JobGuard). The
+policies can be changed with "overrun" in keys.json.
+
+Job             Minutes         Catch up        Overrun         Worker pool
+rebalance       every minute    skip                            (sharding only)
+tweet           0               once            skip            tweet
+follow_back     15, 45          skip            skip            follow
+unfollow        30              skip            cancel          follow
+preload         55              skip            skip            prefetch
+refill          every minute    skip            skip            maintenance
+executor_stats  59              skip
+database_stats  59              skip                            (postgres only)
+
+With "runtime": "asyncio" in keys.json, the scheduler and every bot's jobs run as
+coroutines on one event loop instead (see asyncio_runtime.py). The schedule and
+policies are the same, and blocking calls still run on the worker pools, but
+jobs waiting for a worker cost a coroutine instead of a thread.
+
+With "sharding": true in keys.json (PostgreSQL only), the fleet is split between
+every process running imas765probot, on one dyno or many. Each worker holds
+advisory-lock leases on its share of the bots, and the rebalance job, which runs
+every minute before the other jobs, adjusts the share when workers join or die
+(see database.ShardLeases). A bot's leases are held until its worker exits, so a
+restarted dyno only picks up bots once the old process is gone. A worker that
+takes a bot over reloads its manifest and queue state from the database, and
+tweets for it right away if it has not tweeted since the start of the hour.
+
+Missed tweets are caught up once, since a late tweet is better than a missed one
+(can_tweet still enforces tweet_timeout). An unfollow run that is still waiting
+out the friends/followers rate limit an hour later is cancelled, since the new
+run starts from fresh lists anyway.
+"""
+JOBS = [('rebalance', range(60)),
+        ('tweet', [0]),
+        ('follow_back', [15, 45]),
+        ('unfollow', [30]),
+        ('preload', [55]),
+        ('refill', range(60)),
+        ('executor_stats', [59]),
+        ('database_stats', [59])]
+CATCH_UP = {'rebalance': 'skip',
+            'tweet': 'once',
+            'follow_back': 'skip',
+            'unfollow': 'skip',
+            'preload': 'skip',
+            'refill': 'skip',
+            'executor_stats': 'skip',
+            'database_stats': 'skip'}
+OVERRUN = {'tweet': 'skip',
+           'follow_back': 'skip',
+           'unfollow': 'cancel',
+           'preload': 'skip',
+           'refill': 'skip'}
+
+
 def main():
     print("imas765probot started.")
     
-    while app_enabled:
-        """
-        Tweet a media file and follow back new followers. Files should be tweeted every
-        hour on minute 0, while new followers should be followed back every 30 minutes
-        at minute 15 and 45. Unfollow users who have stopped following every 60 minutes
-        at minute 30. If a queue is empty, a new queue will be generated.
-        
-        The order the bots tweet in is now shuffled every hour. However, the order
-        that bots follow back and unfollow remain static.
-        """
-
-        # Get current minute
-        minute = datetime.datetime.now().minute
-        
-        """
-        Tweet a new media file if current time is on the 0 minute
-        Certain conditions must be satisfied before tweeting, refer to the comments
-        for can_tweet() in bot.py
+    if not app_enabled:
+        return
+    
+    # Worker pools are created once, not for every job
+    pools = executors.create_executors(app_keys)
+    
+    catch_up = dict(CATCH_UP, **app_keys.get('catch_up', {}))
+    overrun = dict(OVERRUN, **app_keys.get('overrun', {}))
+    runtime = app_keys.get('runtime', 'threads')
+    
+    leases = None
+    if app_keys.get('sharding', False):
+        if app_keys.get('storage', 'postgres') != 'postgres':
+            raise ValueError("Sharding needs the postgres storage backend.")
         
-        I use a random sample of the indices for the bot list to simulate a shuffle.
-        This is done instead of using random.shuffle on the bot list because
-        random.shuffle performs an in place shuffle that changes the order of bots
-        in the list. This way, tweets can be in a random order without affecting
-        follow back or unfollow order.
-        """
-        if minute % 60 == 0:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                if shuffle_mode:
-                    for index in sample(range(len(bots)),len(bots)):
-                        if bots[index].can_tweet():
-                            executor.submit(bots[index].tweet)
-                else:
-                    for bot in bots:
-                        if bot.can_tweet():
-                            executor.submit(bot.tweet)
-                
-        # Follow back users (every 30 minutes at minute 15 and 45)
-        if (minute + 15) % 30 == 0:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                for bot in bots:
-                    if bot.follow_back_enabled:
-                        executor.submit(bot.follow_back)
-                
-        # Unfollow users who are no longer following (every hour at minute 30)
-        if (minute + 30) % 60 == 0:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                for bot in bots:
-                    if bot.unfollow_enabled:
-                        executor.submit(bot.unfollow)
-                    
-        # Preload files in advance if enabled
-        if (minute + 5) % 60 == 0:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                for bot in bots:
-                    if bot.preload:
-                        executor.submit(bot.download_latest)
+        import database
+        leases = database.ShardLeases(app_keys['database_url'])
         
-        # If a queue is empty, start a new queue
-        for bot in bots:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                if bot.count_rows(bot.queue_table) == 0:
-                    executor.submit(bot.smart_queue)
-            
-        # Try to align next loop to be as close to HH:MM:00 as possible
-        time.sleep(60 - datetime.datetime.now().second)
+        # Run no bots until the first rebalance (below) claims this worker's share
+        bots[:] = []
+    
+    # Each bot gets one guard per job, so a job cannot overlap with itself
+    if runtime == 'asyncio':
+        offloaders = asyncio_runtime.create_offloaders(pools)
+        asyncio_runtime.install_guards(fleet, overrun)
+        actions = {'tweet': asyncio_runtime.spawn('tweet', tweet_async, offloaders),
+                   'follow_back': functools.partial(follow_back, offloaders['follow']),
+                   'unfollow': functools.partial(unfollow, offloaders['follow']),
+                   'preload': functools.partial(preload, offloaders['prefetch']),
+                   'refill': asyncio_runtime.spawn('refill', refill_async, offloaders),
+                   'rebalance': asyncio_runtime.spawn('rebalance', rebalance_async, leases, offloaders)}
+    else:
+        for bot in fleet:
+            for job, policy in overrun.items():
+                bot.guard(job, policy)
+        actions = {'tweet': functools.partial(tweet, pools['tweet']),
+                   'follow_back': functools.partial(follow_back, pools['follow']),
+                   'unfollow': functools.partial(unfollow, pools['follow']),
+                   'preload': functools.partial(preload, pools['prefetch']),
+                   'refill': functools.partial(refill, pools['maintenance']),
+                   'rebalance': functools.partial(rebalance, leases, pools['tweet'])}
+    actions['executor_stats'] = functools.partial(print_executor_stats, pools)
+    
+    # Claim bots right away instead of at the next minute
+    startup = []
+    if leases is None:
+        del actions['rebalance']
+    else:
+        startup.append(actions['rebalance'])
+    
+    if app_keys.get('storage', 'postgres') == 'postgres':
+        import database
+        actions['database_stats'] = functools.partial(print_database_stats, database.get_pool(app_keys['database_url']))
+    
+    scheduler = Scheduler()
+    for name, minutes in JOBS:
+        # Jobs that do not apply to this configuration (sharding, storage backend)
+        if name not in actions:
+            continue
+        scheduler.add(Job(name, actions[name], minutes, catch_up[name]))
+    
+    if runtime == 'asyncio':
+        # Started on the event loop, once it is running
+        asyncio_runtime.run(scheduler, startup)
+    else:
+        for action in startup:
+            action()
+        scheduler.run()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,166 @@
+# S3 bucket listing helpers
+
+import os
+import time
+import threading
+
+
+def iter_objects(client, bucket, prefix, start_after=None, page_size=1000):
+    """
+    Yields the object summaries (dictionaries with Key, Size, ETag, LastModified, ...)
+    of every file under prefix in bucket, in key order.
+
+    ListObjectsV2 returns at most 1000 keys per call, so the listing is fetched one
+    page at a time using continuation tokens, and each page is only requested once
+    the previous one has been consumed. Only one page is held in memory at a time.
+    Folder placeholder keys (ending with "/") are skipped, and an empty or missing
+    prefix simply yields nothing.
+
+    If start_after is given, only keys that sort after it are listed.
+    """
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': page_size}
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+
+    while True:
+        response = client.list_objects_v2(**kwargs)
+
+        for obj in response.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                yield obj
+
+        if not response.get('IsTruncated'):
+            return
+
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+class ListingService:
+    """
+    Lists buckets on behalf of every bot in the process, so bots that share a bucket
+    do not each list it.
+
+    Bots register the (bucket, prefix) they read from, with a callback. When a bot
+    asks for a full listing of its prefix, the service lists the longest prefix
+    shared by every prefix registered for that bucket once and groups the objects by
+    registered prefix. Every registered callback is then given its group, so every
+    manifest on the bucket does its full refresh from that one listing (see
+    Manifest.apply_listing). Their full refreshes stay aligned, and the bucket is
+    listed once per full refresh interval instead of once per bot.
+
+    The groups are also kept in memory for cache_window seconds. Bots that ask while
+    a listing is running wait for it instead of starting their own, and are then
+    answered from memory. Listings that start after a key (manifest delta refreshes)
+    are answered from the cache when it is fresh, otherwise only that prefix is
+    listed, since one small request is cheaper than re-listing every prefix.
+    """
+
+    def __init__(self, client, cache_window=300):
+        self.client = client
+        self.cache_window = cache_window
+
+        self._lock = threading.Lock()
+        self._prefixes = {} # bucket -> set of registered prefixes
+        self._listeners = {} # bucket -> [(prefix, callback), ...]
+        self._bucket_locks = {}
+        self._cache = {} # bucket -> (time listed, {prefix: [object, ...]})
+
+    def register(self, bucket, prefix, on_listing=None):
+        """
+        Adds prefix to the prefixes listed together for bucket. on_listing, if given,
+        is called with the objects under prefix (a list, in key order) whenever the
+        bucket is listed for any bot.
+        """
+        with self._lock:
+            self._prefixes.setdefault(bucket, set()).add(prefix)
+            self._bucket_locks.setdefault(bucket, threading.Lock())
+            if on_listing is not None:
+                self._listeners.setdefault(bucket, []).append((prefix, on_listing))
+
+    def _cached(self, bucket, prefix):
+        # Returns the cached objects for prefix, or None if they are missing or too old
+        with self._lock:
+            entry = self._cache.get(bucket)
+
+        if entry is None or time.monotonic() - entry[0] >= self.cache_window:
+            return None
+        return entry[1].get(prefix) # None if prefix was registered after the listing
+
+    def _list_bucket(self, bucket):
+        # Lists the common prefix of every registered prefix once, and caches it per prefix
+        with self._lock:
+            prefixes = sorted(self._prefixes.get(bucket, ()))
+
+        # A key belongs to every registered prefix that one of its leading slices is
+        groups = {prefix: [] for prefix in prefixes}
+        lengths = sorted({len(prefix) for prefix in prefixes})
+        for obj in iter_objects(self.client, bucket, os.path.commonprefix(prefixes)):
+            for length in lengths:
+                group = groups.get(obj['Key'][:length])
+                if group is not None:
+                    group.append(obj)
+
+        with self._lock:
+            self._cache[bucket] = (time.monotonic(), groups)
+        return groups
+
+    def _notify(self, bucket, groups):
+        # Hands each registered callback its group, outside every lock
+        with self._lock:
+            listeners = list(self._listeners.get(bucket, ()))
+
+        for prefix, on_listing in listeners:
+            if prefix not in groups:
+                continue
+            try:
+                on_listing(list(groups[prefix]))
+            except Exception as error:
+                print("Could not apply the listing of {0}/{1}. Reason: {2}".format(bucket, prefix, error))
+
+    def objects(self, bucket, prefix, start_after=None):
+        """
+        Returns the object summaries under prefix in bucket, in key order (see
+        iter_objects), as a list. Prefixes that were never registered are listed
+        directly.
+        """
+        with self._lock:
+            registered = prefix in self._prefixes.get(bucket, ())
+            bucket_lock = self._bucket_locks.get(bucket)
+
+        if not registered:
+            return list(iter_objects(self.client, bucket, prefix, start_after))
+
+        objects = self._cached(bucket, prefix)
+
+        if objects is None and start_after is not None:
+            return list(iter_objects(self.client, bucket, prefix, start_after))
+
+        groups = None
+        if objects is None:
+            with bucket_lock:
+                # Another bot may have listed the bucket while this one was waiting
+                objects = self._cached(bucket, prefix)
+                if objects is None:
+                    groups = self._list_bucket(bucket)
+                    objects = groups[prefix]
+
+        if groups is not None:
+            self._notify(bucket, groups)
+
+        if start_after is not None:
+            objects = [obj for obj in objects if obj['Key'] > start_after]
+        return list(objects)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_service(client, cache_window=300):
+    # Returns the process-wide ListingService for client, creating it on first use
+    with _services_lock:
+        service = _services.get(id(client))
+        if service is None:
+            service = ListingService(client, cache_window)
+            _services[id(client)] = service
+        return service
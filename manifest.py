@@ -0,0 +1,240 @@
+# Cached listing of a bot's file pool
+
+import os
+import json
+import datetime
+import threading
+
+import listing
+
+
+class Manifest:
+    """
+    A persisted listing of every file in a bot's S3 folder. Each entry is a
+    (key, size, etag, last_modified) tuple, kept in key order.
+
+    The manifest is stored in a local JSON file (cache_dir/<screen_name>.json) and in
+    the database (through the bot's Storage), so it survives restarts even though
+    Heroku's filesystem does not. It is loaded from the local file if there is one,
+    otherwise from the database.
+
+    refresh() keeps the manifest up to date while touching S3 as little as possible:
+
+    1. If the manifest was refreshed less than refresh_interval seconds ago, nothing
+       is requested from S3.
+    2. If a marker key is configured (an object that operators update whenever they
+       change the folder), only the marker is requested (HEAD). The folder is listed
+       again only if the marker's ETag changed.
+    3. Otherwise only the keys that sort after the newest known key are listed
+       (StartAfter). New uploads usually have increasing names, so this is normally
+       a single request that returns nothing.
+    4. Every full_refresh_interval seconds, the whole folder is listed again to pick
+       up deleted files and files inserted in the middle of the key order.
+
+    snapshot is a number that increases every time the set of files changes.
+
+    If listing_service (a listing.ListingService) is given, the manifest registers
+    its prefix with it and listings go through it, so bots that share a bucket share
+    its listings. A full listing made for any of those bots is also a full refresh
+    of this manifest (see apply_listing).
+    """
+
+    def __init__(self, storage, client, bucket, prefix, cache_dir='manifests', marker_key=None,
+                 refresh_interval=3600, full_refresh_interval=86400, listing_service=None):
+        self.storage = storage
+        self.client = client
+        self.listing_service = listing_service
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_path = os.path.join(cache_dir, '{}.json'.format(storage.bot))
+        self.marker_key = marker_key
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+
+        self._lock = threading.RLock()
+        self._entries = None # Loaded on first use
+        self._state = None
+        self._skip_cache = False # Load from the database even if there is a local cache (see reload)
+        self._refreshing = False # Set while refresh() runs, which applies its own listings
+
+        if listing_service is not None:
+            listing_service.register(bucket, prefix, self.apply_listing)
+
+    def _load(self):
+        if self._entries is not None:
+            return
+
+        state, entries = None, []
+
+        if not self._skip_cache and os.path.isfile(self.cache_path):
+            try:
+                with open(self.cache_path) as cache_file:
+                    cache = json.load(cache_file)
+                state = cache['state']
+                for name in ('full_refresh', 'refreshed'):
+                    state[name] = datetime.datetime.strptime(state[name], '%Y-%m-%dT%H:%M:%S.%f')
+                entries = [tuple(entry) for entry in cache['entries']]
+            except (ValueError, KeyError, TypeError):
+                print("{0}: Could not read manifest cache {1}.".format(self.storage.bot, self.cache_path))
+                state, entries = None, []
+
+        if state is None:
+            state, entries = self.storage.load_manifest()
+
+        self._state = state
+        self._entries = sorted(entries)
+
+        # Bring the local cache up to date with the database copy
+        if self._skip_cache:
+            self._skip_cache = False
+            if state is not None:
+                self._write_cache()
+
+    def _write_cache(self):
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        state = dict(self._state)
+        for name in ('full_refresh', 'refreshed'):
+            state[name] = state[name].strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+        # Write to a temporary file first so a crash never leaves a truncated cache
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'state': state, 'entries': self._entries}, cache_file)
+        os.replace(temp_path, self.cache_path)
+
+    def _save(self, entries=None, full=False):
+        # Persist the state, plus either every entry (full) or only the given new entries
+        self.storage.save_manifest(self._state, self._entries if full else entries, full)
+        self._write_cache()
+
+    @staticmethod
+    def _entries_from(objects):
+        return [(obj['Key'], obj['Size'], obj['ETag'], obj['LastModified'].isoformat()) for obj in objects]
+
+    def _list(self, start_after=None):
+        if self.listing_service is not None:
+            objects = self.listing_service.objects(self.bucket, self.prefix, start_after)
+        else:
+            objects = listing.iter_objects(self.client, self.bucket, self.prefix, start_after)
+
+        return self._entries_from(objects)
+
+    def _marker_etag(self):
+        return self.client.head_object(Bucket=self.bucket, Key=self.marker_key)['ETag']
+
+    def _full_refresh(self, now, marker=None, entries=None):
+        if entries is None:
+            entries = self._list()
+        changed = entries != self._entries
+
+        self._entries = entries
+        self._state = {'snapshot': self._state['snapshot'] + (1 if changed else 0) if self._state else 1,
+                       'marker': marker,
+                       'full_refresh': now,
+                       'refreshed': now}
+        self._save(full=True)
+
+    def refresh(self, force=False):
+        """
+        Bring the manifest up to date (see the class comments). If force is True, the
+        whole folder is listed again regardless of how recently it was refreshed.
+        """
+        with self._lock:
+            self._refreshing = True
+            try:
+                self._refresh(force)
+            finally:
+                self._refreshing = False
+
+    def _refresh(self, force):
+        self._load()
+        now = datetime.datetime.now()
+
+        if self._state is None or force:
+            self._full_refresh(now, self._marker_etag() if self.marker_key else None)
+            return
+
+        if (now - self._state['refreshed']).total_seconds() < self.refresh_interval:
+            return
+
+        if (now - self._state['full_refresh']).total_seconds() >= self.full_refresh_interval:
+            self._full_refresh(now, self._marker_etag() if self.marker_key else None)
+            return
+
+        if self.marker_key:
+            marker = self._marker_etag()
+            if marker != self._state['marker']:
+                self._full_refresh(now, marker)
+                return
+            new_entries = []
+        else:
+            start_after = self._entries[-1][0] if self._entries else None
+            new_entries = self._list(start_after)
+
+        self._entries.extend(new_entries)
+        self._state['refreshed'] = now
+        if new_entries:
+            self._state['snapshot'] += 1
+        self._save(new_entries)
+
+    def apply_listing(self, objects):
+        """
+        Full refresh from a listing of the bucket made for another bot (see
+        listing.ListingService), so every bot on the bucket does its full refresh at
+        the same time and the bucket is listed once for all of them. Skipped if the
+        manifest has not been loaded yet (it is listed when first used), or is being
+        refreshed, which applies its own listing.
+        """
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._entries is None or self._refreshing:
+                return
+            marker = self._state['marker'] if self._state else None
+            self._full_refresh(datetime.datetime.now(), marker, self._entries_from(objects))
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        """
+        Drop a key that turned out to be missing from the bucket (for example when a
+        download fails), so it is not queued again before the next full refresh.
+        """
+        with self._lock:
+            self._load()
+            remaining = [entry for entry in self._entries if entry[0] != key]
+            if len(remaining) == len(self._entries):
+                return
+
+            self._entries = remaining
+            if self._state is not None:
+                self._state['snapshot'] += 1
+                self.storage.delete_manifest_entries([key], self._state)
+                self._write_cache()
+
+    def reload(self):
+        """
+        Drop the manifest held in memory, so it is loaded again on next use, from the
+        database rather than the local cache. Used when this process takes over a bot
+        from another worker, which may have refreshed the manifest since the local
+        copy was written.
+        """
+        with self._lock:
+            self._entries = None
+            self._state = None
+            self._skip_cache = True
+
+    def entries(self):
+        # Returns a copy of the (key, size, etag, last_modified) entries, in key order
+        with self._lock:
+            self._load()
+            return list(self._entries)
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            self._load()
+            return self._state['snapshot'] if self._state else 0
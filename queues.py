@@ -0,0 +1,365 @@
+# Queue generation
+
+import os
+import random
+import datetime
+import mimetypes
+
+
+# Largest size in bytes of each media type that api.media_upload accepts (see tweepy/api.py,
+# _pack_image only takes GIF, JPEG and PNG images)
+MEDIA_SIZE_LIMITS = {'image/gif': 5120 * 1024,
+                     'image/jpeg': 5120 * 1024,
+                     'image/png': 5120 * 1024,
+                     'video/mp4': 15360 * 1024}
+
+_extension_types = {}
+
+
+def is_postable(key, size=None):
+    """
+    Checks if a file can be tweeted: its extension must be a type in MEDIA_SIZE_LIMITS,
+    and its size (if known) must be within the limit for that type.
+    """
+    extension = os.path.splitext(key)[1].lower()
+
+    # Look up each extension once, guess_type is slow for large pools
+    file_type = _extension_types.get(extension)
+    if file_type is None:
+        file_type = mimetypes.guess_type('file' + extension)[0] or ''
+        _extension_types[extension] = file_type
+
+    limit = MEDIA_SIZE_LIMITS.get(file_type)
+    return limit is not None and (size is None or size <= limit)
+
+
+def postable_keys(entries):
+    """
+    Returns the keys of the manifest entries ((key, size, etag, last_modified) tuples)
+    that can be tweeted, and the number of entries that were dropped, as a tuple.
+    """
+    keys = [entry[0] for entry in entries if is_postable(entry[0], entry[1])]
+    return keys, len(entries) - len(keys)
+
+
+def build_queue(keys, recent_files, recent_limit, rng=random):
+    """
+    Returns a new queue (a list of keys, front of the queue first) built from keys,
+    which can be any iterable, including a lazy S3 listing.
+
+    The most recently posted files should not appear at the front of the queue.
+    Files that are not in recent_files are shuffled, and up to recent_limit of
+    them are placed at the front. The remaining files are mixed with the recent
+    files to form the rest of the queue.
+
+    Only files that are in keys are ever returned, so recent files that are no
+    longer in the file pool are not put back into the queue.
+
+    recent_files is turned into a set, so splitting the pool takes linear time
+    no matter how large recent_limit is.
+    """
+    recent = set(recent_files)
+
+    fresh = []
+    stale = []
+    for key in keys:
+        if key in recent:
+            stale.append(key)
+        else:
+            fresh.append(key)
+
+    rng.shuffle(fresh)
+
+    # Determine how many files to place at the front
+    front_size = min(len(fresh), recent_limit)
+    front = fresh[:front_size]
+
+    # Form the rest of the queue, and shuffle again
+    rest = fresh[front_size:]
+    rest.extend(stale)
+    rng.shuffle(rest)
+
+    front.extend(rest)
+    return front
+
+
+def build_weighted_queue(keys, recent_files, recent_limit, last_posted, half_life, now=None, rng=None):
+    """
+    Returns a new queue (a list of keys, front of the queue first) like build_queue,
+    but the order is drawn with weights that depend on when each file was last
+    posted, instead of only on whether it is in recent_files.
+
+    last_posted is a dictionary of key -> datetime of the file's latest tweet. A file
+    posted age seconds ago has weight 1 - 2 ** (-age / half_life): it recovers half
+    of its weight every half_life seconds, and a file that was never posted has
+    weight 1. The whole order is drawn at once with Efraimidis-Spirakis weighted
+    sampling without replacement: every file gets the sort key log(u) / weight for a
+    uniform random u, and the queue is the files sorted by key, largest first.
+
+    The guarantee of build_queue still holds: the first min(fresh files,
+    recent_limit) entries are never in recent_files.
+
+    This needs NumPy 1.17 or later (for default_rng), which is only imported when
+    this function is used. Everything is computed on arrays, so a pool of 100k
+    files takes milliseconds.
+    """
+    import numpy
+
+    if rng is None:
+        rng = numpy.random.default_rng()
+    if now is None:
+        now = datetime.datetime.now()
+
+    keys = list(keys)
+    count = len(keys)
+    if count == 0:
+        return []
+
+    index = {key: position for position, key in enumerate(keys)}
+
+    # Seconds since each file was last posted (infinite if it never was)
+    posted = [(index[key], (now - timestamp).total_seconds()) for key, timestamp in last_posted.items() if key in index]
+    ages = numpy.full(count, numpy.inf)
+    if posted:
+        positions, elapsed = zip(*posted)
+        ages[list(positions)] = numpy.maximum(elapsed, 0)
+
+    # 1 - 2 ** (-age / half_life), kept above zero so log(u) / weight stays finite
+    weights = -numpy.expm1(-ages * (numpy.log(2) / half_life))
+    weights = numpy.maximum(weights, 1e-12)
+
+    sort_keys = numpy.log(rng.random(count)) / weights
+    order = numpy.argsort(-sort_keys, kind='stable')
+
+    # Move the best-ranked fresh files to the front
+    is_recent = numpy.zeros(count, dtype=bool)
+    recent_positions = [index[key] for key in set(recent_files) if key in index]
+    is_recent[recent_positions] = True
+
+    fresh_order = order[~is_recent[order]]
+    front = fresh_order[:min(len(fresh_order), recent_limit)]
+
+    in_front = numpy.zeros(count, dtype=bool)
+    in_front[front] = True
+    rest = order[~in_front[order]]
+
+    return numpy.array(keys, dtype=object)[numpy.concatenate([front, rest])].tolist()
+
+
+class Permutation:
+    """
+    A pseudo-random permutation of range(size), determined by seed. Elements are
+    computed one at a time, so nothing proportional to size is ever stored.
+
+    The permutation is a small Feistel network over the smallest even number of bits
+    that covers size. A Feistel network is invertible by construction, so it maps
+    every index to a distinct value. Values that fall outside range(size) are fed
+    through the network again until they land inside it (cycle walking). The domain
+    is less than four times size, so this takes a few rounds at most on average.
+    """
+
+    ROUNDS = 4
+    MASK64 = (1 << 64) - 1
+
+    def __init__(self, seed, size):
+        self.seed = seed
+        self.size = size
+
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+
+    def _round(self, value, round):
+        # SplitMix64 finalizer over the value, the seed and the round number
+        x = (value + self.seed + (round + 1) * 0x9E3779B97F4A7C15) & self.MASK64
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & self.MASK64
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & self.MASK64
+        return (x ^ (x >> 31)) & self.half_mask
+
+    def _encrypt(self, value):
+        left = value >> self.half_bits
+        right = value & self.half_mask
+        for round in range(self.ROUNDS):
+            left, right = right, left ^ self._round(right, round)
+        return (left << self.half_bits) | right
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("permutation index out of range")
+
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+class PermutationQueue:
+    """
+    A queue that is never written out row by row. Instead, a bot stores one state row
+    (see Storage.load_queue_state) holding a permutation seed, a cursor and the
+    snapshot number of the manifest (see manifest.py) the permutation was built from.
+    The file at the front of the queue is computed from those on demand, so building
+    a queue costs one write no matter how large the file pool is, and so does each
+    tweet.
+
+    The queue order is the file pool permuted by Permutation(seed, size), with one
+    adjustment that keeps the guarantee of build_queue: the first
+    min(fresh files, recent_limit) files are never recent files. When the queue is
+    built, the permutation is walked from the start until that many fresh files have
+    been seen. The recent files met on the way (at most recent_limit of them) are
+    deferred to the end of the queue, and their permutation positions are stored in
+    the state row. The queue is therefore:
+
+    1. permutation positions [0, front) without the deferred positions,
+    2. permutation positions [front, size),
+    3. the deferred positions.
+
+    If the manifest changes (its snapshot no longer matches), the permutation no
+    longer describes the file pool, so the queue counts as empty and is rebuilt.
+    Files found to be missing from the bucket are therefore not removed from the
+    manifest; drop() marks them instead, and claim() skips them until the next full
+    refresh of the manifest drops them.
+    """
+
+    def __init__(self, storage, manifest):
+        self.storage = storage
+        self.manifest = manifest
+
+        self._state = None # Loaded on first use
+        self._loaded = False
+        self._keys = None
+        self._keys_snapshot = None
+        self._missing = set() # Keys to skip until the manifest snapshot changes (see drop)
+
+    def _load(self):
+        if not self._loaded:
+            self._state = self.storage.load_queue_state()
+            self._loaded = True
+        return self._state
+
+    def reload(self):
+        # Drop the state held in memory, so it is loaded from the database again (see Manifest.reload)
+        self._state = None
+        self._loaded = False
+
+    def _pool(self):
+        # Returns the postable manifest keys, cached until the manifest snapshot changes
+        snapshot = self.manifest.snapshot
+        if self._keys is None or self._keys_snapshot != snapshot:
+            self._keys = postable_keys(self.manifest.entries())[0]
+            self._keys_snapshot = snapshot
+            self._missing = set()
+        return self._keys
+
+    def drop(self, key):
+        # Skips key from now on, without changing the manifest (see the class comments)
+        self._pool()
+        self._missing.add(key)
+
+    def build(self, recent_files, recent_limit, rng=random):
+        """
+        Starts a new queue over the current manifest and returns its length. The
+        manifest should be refreshed first.
+        """
+        keys = self._pool()
+        recent = set(recent_files)
+
+        seed = rng.getrandbits(63)
+        permutation = Permutation(seed, len(keys))
+
+        fresh_count = len(keys) - len(recent.intersection(keys))
+        front_size = min(fresh_count, recent_limit)
+
+        deferred = []
+        taken = 0
+        position = 0
+        while taken < front_size:
+            if keys[permutation[position]] in recent:
+                deferred.append(position)
+            else:
+                taken += 1
+            position += 1
+
+        self._state = {'seed': seed,
+                       'size': len(keys),
+                       'front': position,
+                       'deferred': deferred,
+                       'cursor': 0,
+                       'snapshot': self._keys_snapshot}
+        self._loaded = True
+        self.storage.save_queue_state(self._state)
+
+        return len(keys)
+
+    def remaining(self):
+        # Returns the number of files left in the queue (0 if it must be rebuilt)
+        state = self._load()
+        if state is None or state['snapshot'] != self.manifest.snapshot:
+            return 0
+        return state['size'] - state['cursor']
+
+    def _position(self, cursor):
+        # Maps a queue position to a permutation position (see the class comments)
+        state = self._state
+        deferred = state['deferred']
+        before_front = state['front'] - len(deferred)
+
+        if cursor < before_front:
+            position = cursor
+            for skipped in deferred: # Sorted ascending
+                if skipped <= position:
+                    position += 1
+                else:
+                    break
+            return position
+
+        if cursor < state['size'] - len(deferred):
+            return cursor + len(deferred)
+
+        return deferred[cursor - (state['size'] - len(deferred))]
+
+    def claim(self, worker, lease):
+        """
+        Claims the queue for worker (see Storage.claim_queue_state) and returns the
+        filepath at its front, or None if the queue is empty or held by another worker.
+        The state is reloaded by the claim, so another process's progress is picked up.
+        """
+        state = self.storage.claim_queue_state(worker, lease)
+        if state is None:
+            return None
+
+        self._state = state
+        self._loaded = True
+
+        filepath = self.peek()
+        while filepath is not None and filepath in self._missing:
+            self.skip()
+            filepath = self.peek()
+        return filepath
+
+    def peek(self):
+        # Returns the filepath at the front of the queue, or None if the queue is empty
+        if self.remaining() == 0:
+            return None
+
+        state = self._state
+        permutation = Permutation(state['seed'], state['size'])
+        return self._pool()[permutation[self._position(state['cursor'])]]
+
+    def advanced_state(self):
+        # Returns a copy of the state with the front file removed, to be saved with the tweet
+        return dict(self._state, cursor=self._state['cursor'] + 1)
+
+    def commit(self, state):
+        # Makes a state from advanced_state() current once it has been saved
+        self._state = state
+
+    def skip(self):
+        # Drops the file at the front of the queue
+        state = self.advanced_state()
+        self.storage.save_queue_state(state)
+        self.commit(state)
@@ -0,0 +1,147 @@
+# Job scheduler for the main loop
+
+import time
+import heapq
+import asyncio
+import datetime
+
+
+# What to do with runs that were missed because the scheduler fell behind
+CATCH_UP_POLICIES = ('skip', 'once', 'all')
+
+
+class Job:
+    """
+    A job that runs on the minute boundaries (HH:MM:00) whose local minute is in
+    minutes. For example, minutes={0} runs every hour on the hour, and
+    minutes=range(60) runs every minute.
+
+    A run is on time if it starts within grace seconds of its fire time. Runs that
+    start later than that were missed, and catch_up decides what happens to them:
+
+    skip: missed runs are dropped, the job waits for its next fire time
+    once: the job runs once for all of its missed runs
+    all:  the job runs once for every missed run
+    """
+
+    def __init__(self, name, action, minutes, catch_up='skip', grace=59):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError("Unknown catch up policy \"{0}\" for job {1}.".format(catch_up, name))
+
+        self.name = name
+        self.action = action
+        self.minutes = frozenset(minutes)
+        self.catch_up = catch_up
+        self.grace = grace
+
+    def next_fire_time(self, after):
+        # Returns the first minute boundary (epoch seconds) later than after that the job runs on
+        fire_time = (int(after) // 60 + 1) * 60
+
+        # An hour always contains every minute of the hour, DST changes included
+        for _ in range(2 * 60):
+            if datetime.datetime.fromtimestamp(fire_time).minute in self.minutes:
+                return fire_time
+            fire_time += 60
+
+        raise ValueError("Job {} has no valid minutes.".format(self.name))
+
+    def fire_times(self, start, end):
+        # Counts the fire times in (start, end]
+        count = 0
+        fire_time = self.next_fire_time(start)
+        while fire_time <= end:
+            count += 1
+            fire_time = self.next_fire_time(fire_time)
+        return count
+
+
+class Scheduler:
+    """
+    Runs jobs at their fire times. The jobs are kept in a heap of
+    (fire time, insertion order, job), and the scheduler sleeps until the earliest
+    fire time instead of waking up every minute. Fire times are absolute (computed
+    from the schedule, not from when the last run finished), so time spent running
+    jobs never shifts later runs. Jobs due at the same time run in the order they
+    were added.
+
+    Jobs run on the scheduler's thread, so long-running work should be handed off to
+    other threads. An exception raised by a job is printed and does not stop the
+    scheduler.
+    """
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+
+        self._heap = []
+        self._order = 0
+
+    def _push(self, fire_time, job):
+        heapq.heappush(self._heap, (fire_time, self._order, job))
+        self._order += 1
+
+    def add(self, job):
+        self._push(job.next_fire_time(self.clock()), job)
+
+    def _run_job(self, job):
+        try:
+            job.action()
+        except Exception as error:
+            print("Job {0} failed. Reason: {1}".format(job.name, error))
+
+    def run_pending(self):
+        """
+        Runs every job that is due, then returns the number of seconds until the next
+        fire time.
+        """
+        while self._heap:
+            fire_time, order, job = self._heap[0]
+            now = self.clock()
+            if fire_time > now:
+                return fire_time - now
+
+            heapq.heappop(self._heap)
+
+            if now - fire_time <= job.grace:
+                runs = 1
+                last_fire_time = fire_time
+            else:
+                # Late: this run and any later ones that are also past were missed
+                missed = 1 + job.fire_times(fire_time, now)
+                runs = {'skip': 0, 'once': 1, 'all': missed}[job.catch_up]
+                last_fire_time = now
+                print("Job {0} is {1:.0f} seconds late, {2} missed runs ({3}).".format(job.name, now - fire_time, missed, job.catch_up))
+
+            for _ in range(runs):
+                self._run_job(job)
+
+            # If this run took longer than the job's interval, the next fire time is
+            # already past and is handled by the catch up policy on the next pass
+            self._push(job.next_fire_time(last_fire_time), job)
+
+        return None
+
+    def run(self, running=lambda: True):
+        # Runs jobs until running() returns False or there are no jobs
+        while running():
+            delay = self.run_pending()
+            if delay is None:
+                return
+
+            # Wake up again at the next fire time. If the sleep ends early or the
+            # clock was changed, run_pending simply returns the remaining time.
+            self.sleep(delay)
+
+    async def run_async(self, running=lambda: True):
+        """
+        The same as run(), for the asyncio runtime (see asyncio_runtime.py): waits on
+        the event loop instead of sleeping the thread. Job actions are called on the
+        event loop, so they should only start tasks.
+        """
+        while running():
+            delay = self.run_pending()
+            if delay is None:
+                return
+
+            await asyncio.sleep(delay)
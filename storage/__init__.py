@@ -0,0 +1,27 @@
+# Storage backends for bot queues, recent files and sent follow requests
+
+from storage.base import Storage, EPOCH, WORKER_ID
+
+
+def get_backend(app_keys):
+    """
+    Returns the Storage subclass selected by "storage" in the app section of keys.json:
+    "postgres" (the default) or "sqlite". Backends are imported lazily so that the
+    SQLite backend can run without psycopg2 installed.
+    """
+    backend = app_keys.get('storage', 'postgres')
+
+    if backend == 'postgres':
+        from storage.postgres import PostgresStorage
+        return PostgresStorage
+
+    if backend == 'sqlite':
+        from storage.sqlite import SQLiteStorage
+        return SQLiteStorage
+
+    raise ValueError("Unknown storage backend \"{}\" in keys.json.".format(backend))
+
+
+def create_storage(app_keys, bot_keys):
+    # Creates the Storage object for one bot
+    return get_backend(app_keys)(app_keys, bot_keys)
@@ -0,0 +1,165 @@
+# Storage interface shared by every backend
+
+import os
+import socket
+import datetime
+
+
+# Returned by last_tweet_time() when a bot has never tweeted
+EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+# Identifies this process when it claims queue rows (see claim_queue_row)
+WORKER_ID = "{0}:{1}".format(os.environ.get('DYNO') or socket.gethostname(), os.getpid())
+
+# Table names used when keys.json sets "schema_layout" to "shared", and by the
+# SQLite backend. Defined here, where every backend and utils/db_utils.py can
+# import them without psycopg2, so the migrations and the queries cannot drift apart.
+SHARED_TABLES = {'queue_table': 'queue',
+                 'recent_queue_table': 'recent_queue',
+                 'request_sent_table': 'request_sent'}
+
+# Tables that are shared between bots in both layouts (keyed by the bot column)
+MANIFEST_TABLE = 'manifest'
+MANIFEST_STATE_TABLE = 'manifest_state'
+QUEUE_STATE_TABLE = 'queue_state'
+POST_HISTORY_TABLE = 'post_history'
+
+
+class Storage:
+    """
+    Persistence for a single bot: its file queue, its table of recently tweeted files
+    and its table of sent follow requests.
+
+    A queue row is a (filepath, comment, timestamp) tuple, where timestamp is when it
+    was queued. Rows are ordered by a generated id: the front of the queue is the
+    row with the lowest id.
+
+    Backends subclass this and implement every method. One Storage object is created
+    per Bot, but backends are expected to share connections between instances.
+    """
+
+    def __init__(self, bot):
+        # bot is the screen_name of the bot, rows are always keyed by it
+        self.bot = bot
+        # recent_limit the recent queue ring was last checked against (see commit_tweet)
+        self._ring_limit = None
+
+    def queue_count(self):
+        # Returns the number of rows in the queue
+        raise NotImplementedError
+
+    def claim_queue_row(self, worker, lease):
+        """
+        Atomically claims the row closest to the front of the queue that is not claimed
+        by another worker, and returns it (or None). The claim lasts lease seconds, so
+        a worker that dies does not hold a row forever, and a worker can claim a row it
+        already holds again. Claimed rows are skipped by other workers without waiting
+        for them, so several workers can drain the queue at once without posting the
+        same row twice.
+        """
+        raise NotImplementedError
+
+    def delete_queue_file(self, filepath):
+        # Removes every queue row for filepath
+        raise NotImplementedError
+
+    def push_queue(self, filepaths, behind=False):
+        """
+        Adds filepaths to the queue in bulk, in one transaction. filepaths is ordered
+        front of the queue first, and every new row goes in front of the rows already
+        queued, or behind them if behind is True.
+        """
+        raise NotImplementedError
+
+    def queued_files(self):
+        # Returns a list of the filepaths in the queue
+        raise NotImplementedError
+
+    def commit_tweet(self, filepath, recent_limit, queue_state=None):
+        """
+        Removes filepath from the queue and records it as the most recent tweet, all in
+        one transaction. Only the last recent_limit tweets are kept: the recent files
+        are a ring of recent_limit slots, and the new entry replaces the oldest one.
+        If the ring was written with a different recent_limit, it is first trimmed to
+        the last recent_limit entries and renumbered, so no entry inside the window is
+        overwritten.
+        The time the file was posted is also recorded (see last_posted_times).
+
+        If queue_state is given, it is saved in the same transaction (see
+        save_queue_state).
+        """
+        raise NotImplementedError
+
+    def recent_files(self):
+        # Returns a list of the recently tweeted filepaths
+        raise NotImplementedError
+
+    def last_posted_times(self):
+        # Returns a dictionary of filepath -> datetime of its latest tweet, for every file ever tweeted
+        raise NotImplementedError
+
+    def last_tweet_time(self):
+        # Returns the datetime of the most recent tweet, or EPOCH if there is none
+        raise NotImplementedError
+
+    def requests_sent(self, ids):
+        # Returns the subset of ids that have already been sent a follow request, as a set
+        raise NotImplementedError
+
+    def add_requests_sent(self, rows):
+        # Records (id, screen_name, timestamp) rows as sent follow requests, skipping known ids
+        raise NotImplementedError
+
+    def delete_request_sent(self, id):
+        # Forgets that a follow request was sent to id
+        raise NotImplementedError
+
+    def load_queue_state(self):
+        """
+        Returns the state of the bot's permutation queue (see queues.PermutationQueue) as
+        a dictionary with the keys seed, size, front, deferred, cursor and snapshot, or
+        None if there is none. deferred is a list of integers.
+        """
+        raise NotImplementedError
+
+    def save_queue_state(self, state):
+        # Stores the state of the bot's permutation queue, replacing the previous one and ending any claim on it
+        raise NotImplementedError
+
+    def claim_queue_state(self, worker, lease):
+        """
+        Claims the bot's permutation queue for lease seconds, the same way as
+        claim_queue_row, and returns its current state. Returns None if there is no
+        state or another worker holds it.
+        """
+        raise NotImplementedError
+
+    def load_manifest(self):
+        """
+        Returns the bot's stored file manifest (see manifest.py) as a (state, entries)
+        tuple. state is a dictionary with the keys snapshot, marker, full_refresh and
+        refreshed, or None if no manifest has been saved. entries is a list of
+        (key, size, etag, last_modified) tuples.
+        """
+        raise NotImplementedError
+
+    def save_manifest(self, state, entries, full):
+        """
+        Stores the manifest state. If full is True, entries replaces every stored entry,
+        otherwise entries are added to (or updated in) the stored entries.
+        """
+        raise NotImplementedError
+
+    def delete_manifest_entries(self, keys, state):
+        # Removes the given keys from the stored manifest and stores the new state
+        raise NotImplementedError
+
+    @classmethod
+    def fleet_status(cls, storages):
+        """
+        Returns the queue depth and last tweet time of every storage in storages (all of
+        the same backend) as a dictionary keyed by bot. Each value is a dictionary with
+        the keys queue_count and last_tweet. Backends should answer this in one query.
+        """
+        return {storage.bot: {'queue_count': storage.queue_count(), 'last_tweet': storage.last_tweet_time()}
+                for storage in storages}
@@ -0,0 +1,461 @@
+# PostgreSQL storage backend
+
+import json
+import datetime
+import threading
+
+import psycopg2.extras
+
+import database
+from storage.base import (Storage, EPOCH, SHARED_TABLES, MANIFEST_TABLE, MANIFEST_STATE_TABLE,
+                          QUEUE_STATE_TABLE, POST_HISTORY_TABLE)
+
+
+class FleetMonitor:
+    """
+    Queue counts and last tweet times for every bot on one database, kept in memory
+    and updated by notifications from the queue triggers (see utils/db_utils.py,
+    version 8) through a database.Listener.
+
+    While the listener is connected, fleet_status() is answered from memory, so the
+    main loop stops querying the database every minute, and rows queued by hand with
+    db_utils.py are counted as soon as they are committed. Whenever the listener
+    (re)connects, and every resync_interval seconds, the state is reloaded with one
+    fleet_status query.
+
+    The counts depend on the triggers. A bot whose queue table has none (its tables
+    are older than version 8) is still registered, but a warning is printed, since
+    its queue count would only be corrected by the hourly resync.
+    """
+
+    def __init__(self, database_url, resync_interval=3600):
+        self._lock = threading.Lock()
+        self._storages = {}
+        self._status = {}
+
+        self.listener = database.Listener(database_url, database.NOTIFY_CHANNEL, self._notified,
+                                          on_connect=self._resync, resync_interval=resync_interval)
+
+    def register(self, storage):
+        if not storage.has_notify_triggers():
+            print("{0}: {1} has no notify triggers, queue counts will lag until the next resync. "
+                  "Run \"python db_utils.py migrate\" in the utils folder.".format(storage.bot, storage.queue_table))
+
+        with self._lock:
+            self._storages[storage.bot] = storage
+        self.listener.start()
+
+    def _resync(self):
+        with self._lock:
+            storages = list(self._storages.values())
+
+        status = PostgresStorage.query_fleet_status(storages) if storages else {}
+
+        with self._lock:
+            self._status = status
+
+    def load(self, status):
+        # Adds status (from query_fleet_status) for bots that were registered after the last resync
+        with self._lock:
+            for bot, values in status.items():
+                self._status.setdefault(bot, dict(values))
+
+    def _notified(self, payload):
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            return
+
+        with self._lock:
+            values = self._status.get(change.get('bot'))
+            if values is None:
+                return # Not a bot of this process, or not loaded yet
+
+            if change.get('kind') == 'queue':
+                values['queue_count'] = change['count']
+            elif change.get('kind') == 'tweet':
+                timestamp = parse_timestamp(change['timestamp'])
+                values['last_tweet'] = max(values['last_tweet'], timestamp)
+
+    def status(self, bots):
+        # Returns the status of bots, or None if it is not all known
+        if not self.listener.connected:
+            return None
+
+        with self._lock:
+            if any(bot not in self._status for bot in bots):
+                return None
+            return {bot: dict(self._status[bot]) for bot in bots}
+
+
+def parse_timestamp(value):
+    # Parses a timestamp from json_build_object, which leaves out a zero fraction
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+
+def get_monitor(database_url, resync_interval=3600):
+    # Returns the process-wide FleetMonitor for database_url, creating it on first use
+    with _monitors_lock:
+        monitor = _monitors.get(database_url)
+        if monitor is None:
+            monitor = FleetMonitor(database_url, resync_interval)
+            _monitors[database_url] = monitor
+        return monitor
+
+
+class PostgresStorage(Storage):
+    """
+    Storage backed by PostgreSQL through the shared connection pool in database.py.
+
+    With the per_bot schema layout every bot has its own three tables (named in
+    keys.json). With the shared layout every bot uses the tables in
+    storage.base.SHARED_TABLES. Rows are always keyed by the bot column, so the queries
+    are the same for both layouts and only the table names change.
+
+    Run "python db_utils.py migrate" in the utils folder to create the tables.
+    """
+
+    def __init__(self, app_keys, bot_keys):
+        Storage.__init__(self, bot_keys['screen_name'])
+
+        self.schema_layout = app_keys.get('schema_layout', 'per_bot')
+
+        if self.schema_layout == 'shared':
+            tables = SHARED_TABLES
+        else:
+            tables = bot_keys
+
+        self.queue_table = tables['queue_table']
+        self.recent_queue_table = tables['recent_queue_table']
+        self.request_sent_table = tables['request_sent_table']
+
+        # All bots share one connection pool per database
+        self.pool = database.get_pool(app_keys['database_url'],
+                                      app_keys.get('db_pool_size', 10),
+                                      prepare=app_keys.get('db_prepare_statements', True))
+
+        # Keep the fleet status current from notifications instead of polling (see FleetMonitor)
+        if app_keys.get('db_listen', False):
+            self.monitor = get_monitor(app_keys['database_url'], app_keys.get('db_listen_resync', 3600))
+            self.monitor.register(self)
+        else:
+            self.monitor = None
+
+    def has_notify_triggers(self):
+        # True if the queue table has the triggers that FleetMonitor relies on (see utils/db_utils.py, version 8)
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_trigger WHERE tgrelid = to_regclass(%s) AND tgname = %s",
+                        (self.queue_table, '{}_notify_insert'.format(self.queue_table).lower()))
+            return cur.fetchone() is not None
+
+    def _execute(self, cur, kind, sql, params, *tables):
+        # Run one of the hot queries as a prepared statement (see database.ConnectionPool.execute)
+        self.pool.execute(cur, database.statement_name(kind, *tables), sql.format(*tables), params)
+
+    def queue_count(self):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'queue_count',
+                          "SELECT count(*) FROM {0} WHERE bot = $1",
+                          [self.bot], self.queue_table)
+
+            return cur.fetchone()[0]
+
+    def claim_queue_row(self, worker, lease):
+        now = datetime.datetime.now()
+
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'claim_queue_row',
+                          """WITH next AS (SELECT id FROM {0}
+                                           WHERE bot = $1
+                                           AND (claimed_until IS NULL OR claimed_until < $3 OR claimed_by = $2)
+                                           ORDER BY id
+                                           LIMIT 1
+                                           FOR UPDATE SKIP LOCKED)
+                             UPDATE {0} claimed
+                             SET claimed_by = $2, claimed_until = $4
+                             FROM next
+                             WHERE claimed.id = next.id
+                             RETURNING claimed.filepath, claimed.comment, claimed.timestamp""",
+                          [self.bot, worker, now, now + datetime.timedelta(seconds=lease)], self.queue_table)
+
+            return cur.fetchone()
+
+    def delete_queue_file(self, filepath):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'delete_queue_file',
+                          "DELETE FROM {0} WHERE bot = $1 AND filepath = $2",
+                          [self.bot, filepath], self.queue_table)
+
+    def push_queue(self, filepaths, behind=False):
+        with self.pool.cursor() as cur:
+            database.insert_queue(cur, self.queue_table, self.bot, filepaths, front=not behind)
+
+    def queued_files(self):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'queued_files',
+                          "SELECT filepath FROM {0} WHERE bot = $1",
+                          [self.bot], self.queue_table)
+
+            return [row[0] for row in cur.fetchall()]
+
+    def commit_tweet(self, filepath, recent_limit, queue_state=None):
+        """
+        The recent queue table is a ring of recent_limit slots per bot. Each tweet gets
+        the next sequence number and is written into slot (seq mod recent_limit) with an
+        upsert, overwriting the entry that fell out of the window. The same statement
+        also records the time in the post history table.
+
+        Popping the queue and the upserts are one statement, so the whole commit is a
+        single prepared round trip (two with a queue_state). The first commit after
+        recent_limit changes also runs _resize_ring.
+        """
+        with self.pool.cursor() as cur:
+            if recent_limit != self._ring_limit:
+                self._resize_ring(cur, recent_limit)
+
+            self._execute(cur, 'commit_tweet',
+                          """WITH popped AS (DELETE FROM {0} WHERE bot = $1 AND filepath = $2),
+                                  recorded AS (INSERT INTO {1} (bot, slot, seq, filepath, timestamp)
+                                               SELECT $1::text, mod(next.seq, $4::integer), next.seq, $2::text, $3::timestamp
+                                               FROM (SELECT coalesce(max(seq) + 1, 0) AS seq FROM {1} WHERE bot = $1) AS next
+                                               ON CONFLICT (bot, slot)
+                                               DO UPDATE SET seq = EXCLUDED.seq, filepath = EXCLUDED.filepath, timestamp = EXCLUDED.timestamp)
+                             INSERT INTO {2} (bot, filepath, last_posted)
+                             VALUES ($1, $2, $3)
+                             ON CONFLICT (bot, filepath)
+                             DO UPDATE SET last_posted = EXCLUDED.last_posted""",
+                          [self.bot, filepath, datetime.datetime.now(), recent_limit], self.queue_table, self.recent_queue_table, POST_HISTORY_TABLE)
+
+            if queue_state is not None:
+                self._save_queue_state(cur, queue_state)
+
+        self._ring_limit = recent_limit
+
+    def _resize_ring(self, cur, recent_limit):
+        """
+        If any entry of the ring is not in slot (seq mod recent_limit), the ring was
+        written with another recent_limit, and new entries would overwrite entries
+        that are still inside the window. Keep the last recent_limit entries and move
+        each to its slot. The slots are negated first, because the primary key is
+        checked row by row during an UPDATE.
+        """
+        params = {'bot': self.bot, 'limit': recent_limit}
+
+        cur.execute("SELECT 1 FROM {} WHERE bot = %(bot)s AND slot <> mod(seq, %(limit)s) LIMIT 1".format(self.recent_queue_table), params)
+        if cur.fetchone() is None:
+            return
+
+        cur.execute("""DELETE FROM {0}
+                       WHERE bot = %(bot)s
+                       AND seq <= (SELECT max(seq) FROM {0} WHERE bot = %(bot)s) - %(limit)s""".format(self.recent_queue_table), params)
+        cur.execute("UPDATE {} SET slot = -1 - slot WHERE bot = %(bot)s".format(self.recent_queue_table), params)
+        cur.execute("UPDATE {} SET slot = mod(seq, %(limit)s) WHERE bot = %(bot)s".format(self.recent_queue_table), params)
+
+    def recent_files(self):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'recent_files',
+                          "SELECT filepath FROM {0} WHERE bot = $1",
+                          [self.bot], self.recent_queue_table)
+
+            return [row[0] for row in cur.fetchall()]
+
+    def last_posted_times(self):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'last_posted_times',
+                          "SELECT filepath, last_posted FROM {0} WHERE bot = $1",
+                          [self.bot], POST_HISTORY_TABLE)
+
+            return dict(cur.fetchall())
+
+    def last_tweet_time(self):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'last_tweet_time',
+                          "SELECT timestamp FROM {0} WHERE bot = $1 ORDER BY seq DESC LIMIT 1",
+                          [self.bot], self.recent_queue_table)
+
+            row = cur.fetchone()
+
+        return EPOCH if row is None else row[0]
+
+    def requests_sent(self, ids):
+        if not ids:
+            return set()
+
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'requests_sent',
+                          "SELECT id FROM {0} WHERE bot = $1 AND id = ANY($2::text[])",
+                          [self.bot, list(ids)], self.request_sent_table)
+
+            return {row[0] for row in cur.fetchall()}
+
+    def add_requests_sent(self, rows):
+        # The rows are passed as three parallel arrays, so any number of rows fits one prepared statement
+        if not rows:
+            return
+
+        ids, screen_names, timestamps = zip(*rows)
+
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'add_requests_sent',
+                          """INSERT INTO {0} (bot, id, screen_name, timestamp)
+                             SELECT $1, sent.id, sent.screen_name, sent.timestamp
+                             FROM unnest($2::text[], $3::text[], $4::timestamp[]) AS sent(id, screen_name, timestamp)
+                             ON CONFLICT DO NOTHING""",
+                          [self.bot, list(ids), list(screen_names), list(timestamps)], self.request_sent_table)
+
+    def delete_request_sent(self, id):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'delete_request_sent',
+                          "DELETE FROM {0} WHERE bot = $1 AND id = $2",
+                          [self.bot, id], self.request_sent_table)
+
+    def load_queue_state(self):
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'load_queue_state',
+                          "SELECT seed, size, front, deferred, cursor, snapshot FROM {0} WHERE bot = $1",
+                          [self.bot], QUEUE_STATE_TABLE)
+
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(('seed', 'size', 'front', 'deferred', 'cursor', 'snapshot'), row))
+
+    def _save_queue_state(self, cur, state):
+        self._execute(cur, 'save_queue_state',
+                      """INSERT INTO {0} (bot, seed, size, front, deferred, cursor, snapshot)
+                         VALUES ($1, $2, $3, $4, $5::integer[], $6, $7)
+                         ON CONFLICT (bot)
+                         DO UPDATE SET seed = EXCLUDED.seed, size = EXCLUDED.size, front = EXCLUDED.front,
+                                       deferred = EXCLUDED.deferred, cursor = EXCLUDED.cursor, snapshot = EXCLUDED.snapshot,
+                                       claimed_by = NULL, claimed_until = NULL""",
+                      [self.bot, state['seed'], state['size'], state['front'], list(state['deferred']), state['cursor'], state['snapshot']],
+                      QUEUE_STATE_TABLE)
+
+    def save_queue_state(self, state):
+        with self.pool.cursor() as cur:
+            self._save_queue_state(cur, state)
+
+    def claim_queue_state(self, worker, lease):
+        now = datetime.datetime.now()
+
+        with self.pool.cursor() as cur:
+            self._execute(cur, 'claim_queue_state',
+                          """UPDATE {0}
+                             SET claimed_by = $2, claimed_until = $4
+                             WHERE bot = $1
+                             AND (claimed_until IS NULL OR claimed_until < $3 OR claimed_by = $2)
+                             RETURNING seed, size, front, deferred, cursor, snapshot""",
+                          [self.bot, worker, now, now + datetime.timedelta(seconds=lease)], QUEUE_STATE_TABLE)
+
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(('seed', 'size', 'front', 'deferred', 'cursor', 'snapshot'), row))
+
+    def load_manifest(self):
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT snapshot, marker, full_refresh, refreshed FROM {} WHERE bot = %s".format(MANIFEST_STATE_TABLE), (self.bot,))
+
+            row = cur.fetchone()
+            if row is None:
+                return None, []
+
+            state = dict(zip(('snapshot', 'marker', 'full_refresh', 'refreshed'), row))
+
+            cur.execute("SELECT key, size, etag, last_modified FROM {} WHERE bot = %s".format(MANIFEST_TABLE), (self.bot,))
+
+            return state, [tuple(entry) for entry in cur.fetchall()]
+
+    def _save_manifest_state(self, cur, state):
+        cur.execute("""INSERT INTO {} (bot, snapshot, marker, full_refresh, refreshed)
+                       VALUES (%(bot)s, %(snapshot)s, %(marker)s, %(full_refresh)s, %(refreshed)s)
+                       ON CONFLICT (bot)
+                       DO UPDATE SET snapshot = EXCLUDED.snapshot, marker = EXCLUDED.marker,
+                                     full_refresh = EXCLUDED.full_refresh, refreshed = EXCLUDED.refreshed""".format(MANIFEST_STATE_TABLE),
+                    dict(state, bot=self.bot))
+
+    def save_manifest(self, state, entries, full):
+        with self.pool.cursor() as cur:
+            if full:
+                cur.execute("DELETE FROM {} WHERE bot = %s".format(MANIFEST_TABLE), (self.bot,))
+
+            if entries:
+                psycopg2.extras.execute_values(cur,
+                                               """INSERT INTO {} (bot, key, size, etag, last_modified) VALUES %s
+                                                  ON CONFLICT (bot, key)
+                                                  DO UPDATE SET size = EXCLUDED.size, etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified""".format(MANIFEST_TABLE),
+                                               [(self.bot,) + tuple(entry) for entry in entries],
+                                               page_size=1000)
+
+            self._save_manifest_state(cur, state)
+
+    def delete_manifest_entries(self, keys, state):
+        with self.pool.cursor() as cur:
+            cur.execute("DELETE FROM {} WHERE bot = %s AND key = ANY(%s)".format(MANIFEST_TABLE), (self.bot, list(keys)))
+            self._save_manifest_state(cur, state)
+
+    @classmethod
+    def fleet_status(cls, storages):
+        """
+        Answered from the FleetMonitor when db_listen is enabled and it knows every bot,
+        otherwise queried (see query_fleet_status).
+        """
+        if not storages:
+            return {}
+
+        monitor = storages[0].monitor
+        if monitor is not None:
+            status = monitor.status([storage.bot for storage in storages])
+            if status is not None:
+                return status
+
+        status = cls.query_fleet_status(storages)
+        if monitor is not None:
+            monitor.load(status)
+        return status
+
+    @staticmethod
+    def query_fleet_status(storages):
+        """
+        In the per_bot layout the query has one UNION ALL branch per bot, in the shared
+        layout it is a single pass over the shared tables.
+        """
+        first = storages[0]
+
+        if first.schema_layout == 'shared':
+            sql = """SELECT fleet.bot,
+                            (SELECT count(*) FROM {0} WHERE bot = fleet.bot),
+                            (SELECT timestamp FROM {1} WHERE bot = fleet.bot ORDER BY seq DESC LIMIT 1)
+                     FROM unnest($1::text[]) AS fleet(bot)"""
+            params = [[storage.bot for storage in storages]]
+            tables = [first.queue_table, first.recent_queue_table]
+        else:
+            selects = []
+            params = []
+            tables = []
+            for index, storage in enumerate(storages):
+                selects.append("""SELECT ${0}::text,
+                                         (SELECT count(*) FROM {{{1}}} WHERE bot = ${0}),
+                                         (SELECT timestamp FROM {{{2}}} WHERE bot = ${0} ORDER BY seq DESC LIMIT 1)""".format(index + 1, 2 * index, 2 * index + 1))
+                params.append(storage.bot)
+                tables.extend([storage.queue_table, storage.recent_queue_table])
+            sql = " UNION ALL ".join(selects)
+
+        with first.pool.cursor() as cur:
+            first._execute(cur, 'fleet_status', sql, params, *tables)
+
+            rows = cur.fetchall()
+
+        return {bot: {'queue_count': queue_count, 'last_tweet': EPOCH if last_tweet is None else last_tweet}
+                for bot, queue_count, last_tweet in rows}
@@ -0,0 +1,431 @@
+# SQLite storage backend
+
+import datetime
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from storage.base import (Storage, EPOCH, SHARED_TABLES, MANIFEST_TABLE, MANIFEST_STATE_TABLE,
+                          QUEUE_STATE_TABLE, POST_HISTORY_TABLE)
+
+
+# Every bot's rows are kept in the shared tables, so the names come from storage.base
+TABLES = dict(SHARED_TABLES,
+              manifest_table=MANIFEST_TABLE,
+              manifest_state_table=MANIFEST_STATE_TABLE,
+              queue_state_table=QUEUE_STATE_TABLE,
+              post_history_table=POST_HISTORY_TABLE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS {queue_table} (id INTEGER PRIMARY KEY,
+                                          bot TEXT NOT NULL,
+                                          filepath TEXT,
+                                          comment TEXT,
+                                          timestamp TIMESTAMP,
+                                          claimed_by TEXT,
+                                          claimed_until TIMESTAMP);
+CREATE INDEX IF NOT EXISTS queue_bot_filepath_idx ON {queue_table} (bot, filepath);
+
+CREATE TABLE IF NOT EXISTS {recent_queue_table} (bot TEXT NOT NULL,
+                                                 slot INTEGER NOT NULL,
+                                                 seq INTEGER NOT NULL,
+                                                 filepath TEXT,
+                                                 timestamp TIMESTAMP,
+                                                 PRIMARY KEY (bot, slot));
+
+CREATE TABLE IF NOT EXISTS {request_sent_table} (bot TEXT NOT NULL,
+                                                 id TEXT NOT NULL,
+                                                 screen_name TEXT,
+                                                 timestamp TIMESTAMP,
+                                                 PRIMARY KEY (bot, id));
+
+CREATE TABLE IF NOT EXISTS {manifest_table} (bot TEXT NOT NULL,
+                                             key TEXT NOT NULL,
+                                             size INTEGER,
+                                             etag TEXT,
+                                             last_modified TEXT,
+                                             PRIMARY KEY (bot, key));
+
+CREATE TABLE IF NOT EXISTS {manifest_state_table} (bot TEXT PRIMARY KEY,
+                                                   snapshot INTEGER NOT NULL,
+                                                   marker TEXT,
+                                                   full_refresh TIMESTAMP,
+                                                   refreshed TIMESTAMP);
+
+CREATE TABLE IF NOT EXISTS {queue_state_table} (bot TEXT PRIMARY KEY,
+                                                seed INTEGER NOT NULL,
+                                                size INTEGER NOT NULL,
+                                                front INTEGER NOT NULL,
+                                                deferred TEXT NOT NULL,
+                                                cursor INTEGER NOT NULL,
+                                                snapshot INTEGER NOT NULL,
+                                                claimed_by TEXT,
+                                                claimed_until TIMESTAMP);
+
+CREATE TABLE IF NOT EXISTS {post_history_table} (bot TEXT NOT NULL,
+                                                 filepath TEXT NOT NULL,
+                                                 last_posted TIMESTAMP NOT NULL,
+                                                 PRIMARY KEY (bot, filepath));
+""".format(**TABLES)
+
+# Indexes that depend on columns added by upgrade(), and the post history of files
+# tweeted before the post_history table existed
+INDEXES = """
+CREATE INDEX IF NOT EXISTS queue_bot_id_idx ON {queue_table} (bot, id);
+CREATE INDEX IF NOT EXISTS recent_queue_bot_seq_idx ON {recent_queue_table} (bot, seq);
+CREATE INDEX IF NOT EXISTS recent_queue_bot_filepath_idx ON {recent_queue_table} (bot, filepath);
+
+INSERT OR IGNORE INTO {post_history_table} (bot, filepath, last_posted)
+SELECT bot, filepath, max(timestamp) FROM {recent_queue_table}
+WHERE filepath IS NOT NULL AND timestamp IS NOT NULL
+GROUP BY bot, filepath;
+""".format(**TABLES)
+
+
+class SQLiteDatabase:
+    """
+    A single SQLite database file in WAL mode, shared by every bot in the process.
+
+    sqlite3 connections cannot be shared between threads, so each thread gets its own
+    connection. WAL mode lets readers run while another thread is writing. The schema
+    is created the first time the file is opened.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        with self.cursor() as cur:
+            cur.executescript(SCHEMA)
+            self.upgrade(cur)
+            cur.executescript(INDEXES)
+
+    def upgrade(self, cur):
+        """
+        Bring a database file created by an older version up to date. Files created
+        before the recent queue became a ring have an id column instead of slot and
+        seq. Existing rows are numbered oldest first and each keeps its own slot;
+        the first commit_tweet trims them to recent_limit and moves them into the ring
+        (see _resize_ring). Files created before queue claims are given the claim
+        columns. Files created before the queue was ordered by id (they still have the
+        queue_bot_timestamp_idx index) have their queue rows renumbered, newest
+        timestamp first, above every id in use.
+        """
+        if cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'queue_bot_timestamp_idx'").fetchone():
+            top = cur.execute("SELECT coalesce(max(id), 0) FROM {queue_table}".format(**TABLES)).fetchone()[0]
+            ids = cur.execute("SELECT id FROM {queue_table} ORDER BY bot, timestamp DESC, id".format(**TABLES)).fetchall()
+            cur.executemany("UPDATE {queue_table} SET id = ? WHERE id = ?".format(**TABLES),
+                            [(top + position + 1, id) for position, (id,) in enumerate(ids)])
+            cur.execute("DROP INDEX queue_bot_timestamp_idx")
+
+        for table in (TABLES['queue_table'], TABLES['queue_state_table']):
+            columns = [row[1] for row in cur.execute("PRAGMA table_info({})".format(table))]
+            if 'claimed_by' not in columns:
+                cur.execute("ALTER TABLE {} ADD COLUMN claimed_by TEXT".format(table))
+                cur.execute("ALTER TABLE {} ADD COLUMN claimed_until TIMESTAMP".format(table))
+
+        columns = [row[1] for row in cur.execute("PRAGMA table_info({recent_queue_table})".format(**TABLES))]
+        if 'seq' in columns:
+            return
+
+        cur.execute("ALTER TABLE {recent_queue_table} ADD COLUMN slot INTEGER".format(**TABLES))
+        cur.execute("ALTER TABLE {recent_queue_table} ADD COLUMN seq INTEGER".format(**TABLES))
+
+        numbers = {}
+        rows = cur.execute("SELECT id, bot FROM {recent_queue_table} ORDER BY bot, timestamp, id".format(**TABLES)).fetchall()
+        for id, bot in rows:
+            seq = numbers.get(bot, 0)
+            numbers[bot] = seq + 1
+            cur.execute("UPDATE {recent_queue_table} SET slot = ?, seq = ? WHERE id = ?".format(**TABLES), (seq, seq, id))
+
+        cur.execute("DROP INDEX IF EXISTS recent_queue_bot_timestamp_idx")
+        cur.execute("CREATE UNIQUE INDEX recent_queue_bot_slot_idx ON {recent_queue_table} (bot, slot)".format(**TABLES))
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path,
+                                   timeout=self.timeout,
+                                   detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def cursor(self):
+        """
+        Context manager that yields a cursor on this thread's connection. The transaction
+        is committed when the block exits normally and rolled back otherwise.
+        """
+        conn = self._connection()
+        cur = conn.cursor()
+        try:
+            yield cur
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path):
+    # Returns the process-wide SQLiteDatabase for path, creating it on first use
+    with _databases_lock:
+        db = _databases.get(path)
+        if db is None:
+            db = SQLiteDatabase(path)
+            _databases[path] = db
+        return db
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage backed by a local SQLite file (sqlite_path in keys.json). Every bot's rows
+    are kept in one queue, one recent_queue and one request_sent table keyed by the
+    bot column, the same as the shared PostgreSQL layout. The table names in a bot's
+    keys.json entry are not used.
+    """
+
+    def __init__(self, app_keys, bot_keys):
+        Storage.__init__(self, bot_keys['screen_name'])
+
+        self.db = get_database(app_keys.get('sqlite_path', 'imas765probot.db'))
+
+    def queue_count(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT count(*) FROM {queue_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            return cur.fetchone()[0]
+
+    def claim_queue_row(self, worker, lease):
+        # SQLite has a single writer, so the claim and the read back cannot interleave with another claim
+        now = datetime.datetime.now()
+        until = now + datetime.timedelta(seconds=lease)
+
+        with self.db.cursor() as cur:
+            cur.execute("""UPDATE {queue_table}
+                           SET claimed_by = :worker, claimed_until = :until
+                           WHERE id = (SELECT id FROM {queue_table}
+                                       WHERE bot = :bot
+                                       AND (claimed_until IS NULL OR claimed_until < :now OR claimed_by = :worker)
+                                       ORDER BY id
+                                       LIMIT 1)""".format(**TABLES),
+                        {'bot': self.bot, 'worker': worker, 'now': now, 'until': until})
+            if cur.rowcount == 0:
+                return None
+
+            cur.execute("""SELECT filepath, comment, timestamp FROM {queue_table}
+                           WHERE bot = ? AND claimed_by = ? AND claimed_until = ?
+                           ORDER BY id LIMIT 1""".format(**TABLES), (self.bot, worker, until))
+
+            return cur.fetchone()
+
+    def delete_queue_file(self, filepath):
+        with self.db.cursor() as cur:
+            cur.execute("DELETE FROM {queue_table} WHERE bot = ? AND filepath = ?".format(**TABLES), (self.bot, filepath))
+
+    def push_queue(self, filepaths, behind=False):
+        # Same id order as database.insert_queue: new rowids are above every id in use,
+        # and rows pushed in front take the ids below the lowest one
+        filepaths = list(filepaths)
+        timestamp = datetime.datetime.now()
+
+        with self.db.cursor() as cur:
+            if behind:
+                rows = ((self.bot, filepath, None, timestamp) for filepath in filepaths)
+                cur.executemany("INSERT INTO {queue_table} (bot, filepath, comment, timestamp) VALUES (?, ?, ?, ?)".format(**TABLES), rows)
+                return
+
+            cur.execute("SELECT coalesce(min(id), 1) FROM {queue_table}".format(**TABLES))
+            first = cur.fetchone()[0] - len(filepaths)
+
+            rows = ((first + position, self.bot, filepath, None, timestamp) for position, filepath in enumerate(filepaths))
+            cur.executemany("INSERT INTO {queue_table} (id, bot, filepath, comment, timestamp) VALUES (?, ?, ?, ?, ?)".format(**TABLES), rows)
+
+    def queued_files(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT filepath FROM {queue_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            return [row[0] for row in cur.fetchall()]
+
+    def commit_tweet(self, filepath, recent_limit, queue_state=None):
+        # Same ring of recent_limit slots as the PostgreSQL backend
+        timestamp = datetime.datetime.now()
+
+        with self.db.cursor() as cur:
+            if recent_limit != self._ring_limit:
+                self._resize_ring(cur, recent_limit)
+
+            cur.execute("DELETE FROM {queue_table} WHERE bot = ? AND filepath = ?".format(**TABLES), (self.bot, filepath))
+            cur.execute("""INSERT OR REPLACE INTO {recent_queue_table} (bot, slot, seq, filepath, timestamp)
+                           SELECT :bot, next.seq % :limit, next.seq, :filepath, :timestamp
+                           FROM (SELECT coalesce(max(seq) + 1, 0) AS seq FROM {recent_queue_table} WHERE bot = :bot) AS next""".format(**TABLES),
+                        {'bot': self.bot, 'filepath': filepath, 'timestamp': timestamp, 'limit': recent_limit})
+            cur.execute("INSERT OR REPLACE INTO {post_history_table} (bot, filepath, last_posted) VALUES (?, ?, ?)".format(**TABLES),
+                        (self.bot, filepath, timestamp))
+
+            if queue_state is not None:
+                self._save_queue_state(cur, queue_state)
+
+        self._ring_limit = recent_limit
+
+    def _resize_ring(self, cur, recent_limit):
+        # Same as PostgresStorage._resize_ring
+        params = {'bot': self.bot, 'limit': recent_limit}
+
+        cur.execute("SELECT 1 FROM {recent_queue_table} WHERE bot = :bot AND slot <> seq % :limit LIMIT 1".format(**TABLES), params)
+        if cur.fetchone() is None:
+            return
+
+        cur.execute("""DELETE FROM {recent_queue_table}
+                       WHERE bot = :bot
+                       AND seq <= (SELECT max(seq) FROM {recent_queue_table} WHERE bot = :bot) - :limit""".format(**TABLES), params)
+        cur.execute("UPDATE {recent_queue_table} SET slot = -1 - slot WHERE bot = :bot".format(**TABLES), params)
+        cur.execute("UPDATE {recent_queue_table} SET slot = seq % :limit WHERE bot = :bot".format(**TABLES), params)
+
+    def recent_files(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT filepath FROM {recent_queue_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            return [row[0] for row in cur.fetchall()]
+
+    def last_posted_times(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT filepath, last_posted FROM {post_history_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            return dict(cur.fetchall())
+
+    def last_tweet_time(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT timestamp FROM {recent_queue_table} WHERE bot = ? ORDER BY seq DESC LIMIT 1".format(**TABLES), (self.bot,))
+
+            row = cur.fetchone()
+
+        return EPOCH if row is None else row[0]
+
+    def requests_sent(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+
+        sent = set()
+
+        # Older SQLite builds allow at most 999 parameters per statement
+        with self.db.cursor() as cur:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cur.execute("SELECT id FROM {request_sent_table} WHERE bot = ? AND id IN ({ids})".format(ids=", ".join(["?"] * len(chunk)), **TABLES), [self.bot] + chunk)
+                sent.update(row[0] for row in cur.fetchall())
+
+        return sent
+
+    def add_requests_sent(self, rows):
+        with self.db.cursor() as cur:
+            cur.executemany("INSERT OR IGNORE INTO {request_sent_table} (bot, id, screen_name, timestamp) VALUES (?, ?, ?, ?)".format(**TABLES),
+                            [(self.bot, id, screen_name, timestamp) for id, screen_name, timestamp in rows])
+
+    def delete_request_sent(self, id):
+        with self.db.cursor() as cur:
+            cur.execute("DELETE FROM {request_sent_table} WHERE bot = ? AND id = ?".format(**TABLES), (self.bot, id))
+
+    def load_queue_state(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT seed, size, front, deferred, cursor, snapshot FROM {queue_state_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        state = dict(zip(('seed', 'size', 'front', 'deferred', 'cursor', 'snapshot'), row))
+        state['deferred'] = json.loads(state['deferred']) # Stored as a JSON list
+        return state
+
+    def _save_queue_state(self, cur, state):
+        cur.execute("""INSERT OR REPLACE INTO {queue_state_table} (bot, seed, size, front, deferred, cursor, snapshot)
+                       VALUES (:bot, :seed, :size, :front, :deferred, :cursor, :snapshot)""".format(**TABLES),
+                    dict(state, bot=self.bot, deferred=json.dumps(list(state['deferred']))))
+
+    def save_queue_state(self, state):
+        with self.db.cursor() as cur:
+            self._save_queue_state(cur, state)
+
+    def claim_queue_state(self, worker, lease):
+        now = datetime.datetime.now()
+
+        with self.db.cursor() as cur:
+            cur.execute("""UPDATE {queue_state_table}
+                           SET claimed_by = :worker, claimed_until = :until
+                           WHERE bot = :bot
+                           AND (claimed_until IS NULL OR claimed_until < :now OR claimed_by = :worker)""".format(**TABLES),
+                        {'bot': self.bot, 'worker': worker, 'now': now, 'until': now + datetime.timedelta(seconds=lease)})
+            if cur.rowcount == 0:
+                return None
+
+            cur.execute("SELECT seed, size, front, deferred, cursor, snapshot FROM {queue_state_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            state = dict(zip(('seed', 'size', 'front', 'deferred', 'cursor', 'snapshot'), cur.fetchone()))
+
+        state['deferred'] = json.loads(state['deferred'])
+        return state
+
+    def load_manifest(self):
+        with self.db.cursor() as cur:
+            cur.execute("SELECT snapshot, marker, full_refresh, refreshed FROM {manifest_state_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            row = cur.fetchone()
+            if row is None:
+                return None, []
+
+            state = dict(zip(('snapshot', 'marker', 'full_refresh', 'refreshed'), row))
+
+            cur.execute("SELECT key, size, etag, last_modified FROM {manifest_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            return state, [tuple(entry) for entry in cur.fetchall()]
+
+    def _save_manifest_state(self, cur, state):
+        cur.execute("""INSERT OR REPLACE INTO {manifest_state_table} (bot, snapshot, marker, full_refresh, refreshed)
+                       VALUES (:bot, :snapshot, :marker, :full_refresh, :refreshed)""".format(**TABLES),
+                    dict(state, bot=self.bot))
+
+    def save_manifest(self, state, entries, full):
+        with self.db.cursor() as cur:
+            if full:
+                cur.execute("DELETE FROM {manifest_table} WHERE bot = ?".format(**TABLES), (self.bot,))
+
+            cur.executemany("INSERT OR REPLACE INTO {manifest_table} (bot, key, size, etag, last_modified) VALUES (?, ?, ?, ?, ?)".format(**TABLES),
+                            [(self.bot,) + tuple(entry) for entry in entries])
+
+            self._save_manifest_state(cur, state)
+
+    def delete_manifest_entries(self, keys, state):
+        with self.db.cursor() as cur:
+            cur.executemany("DELETE FROM {manifest_table} WHERE bot = ? AND key = ?".format(**TABLES), [(self.bot, key) for key in keys])
+            self._save_manifest_state(cur, state)
+
+    @classmethod
+    def fleet_status(cls, storages):
+        if not storages:
+            return {}
+
+        bots = [storage.bot for storage in storages]
+
+        with storages[0].db.cursor() as cur:
+            cur.execute("""WITH fleet(bot) AS (VALUES {bots})
+                           SELECT fleet.bot,
+                                  (SELECT count(*) FROM {queue_table} WHERE bot = fleet.bot),
+                                  (SELECT timestamp FROM {recent_queue_table} WHERE bot = fleet.bot ORDER BY seq DESC LIMIT 1) AS "last_tweet [timestamp]"
+                           FROM fleet""".format(bots=", ".join(["(?)"] * len(bots)), **TABLES), bots)
+
+            rows = cur.fetchall()
+
+        return {bot: {'queue_count': queue_count, 'last_tweet': EPOCH if last_tweet is None else last_tweet}
+                for bot, queue_count, last_tweet in rows}
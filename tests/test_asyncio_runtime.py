@@ -0,0 +1,64 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import executors
+import asyncio_runtime
+
+
+class OneTickScheduler:
+    # Stands in for scheduler.Scheduler: yields to the event loop for a moment, then has no jobs
+    async def run_async(self):
+        await asyncio.sleep(0.05)
+
+
+class RunTest(unittest.TestCase):
+
+    def test_startup_actions_run_on_the_loop(self):
+        # main() hands the initial rebalance to run() like this when sharding is on
+        ran = []
+
+        async def rebalance_async():
+            ran.append(asyncio.get_event_loop())
+
+        action = asyncio_runtime.spawn('rebalance', rebalance_async)
+        asyncio_runtime.run(OneTickScheduler(), [action])
+
+        self.assertEqual(len(ran), 1)
+        self.assertTrue(ran[0].is_closed())
+
+
+class AsyncJobGuardTest(unittest.TestCase):
+
+    def test_cancel_drops_a_run_still_waiting_for_the_offloader(self):
+        ran = []
+        pool = executors.BoundedExecutor('test', 1)
+        offloader = asyncio_runtime.Offloader(pool)
+        blocker = asyncio_runtime.AsyncJobGuard('blocker')
+        guard = asyncio_runtime.AsyncJobGuard('job', 'cancel')
+
+        async def scenario():
+            # Hold the only worker, so the guarded run waits for the offloader
+            blocker.dispatch(offloader, lambda: blocker.wait(0.2))
+            await asyncio.sleep(0)
+            guard.dispatch(offloader, lambda: ran.append('first'))
+            await asyncio.sleep(0)
+            guard.dispatch(offloader, lambda: ran.append('second'))
+            while blocker.busy or guard.busy:
+                await asyncio.sleep(0.01)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(scenario())
+        finally:
+            loop.close()
+            pool.shutdown()
+
+        self.assertEqual(ran, ['second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
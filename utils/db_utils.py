@@ -1,13 +1,29 @@
+import os
+import sys
 import json
 import psycopg2
 import datetime
 from urllib.parse import urlparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Table names and the notification channel are shared with the bot (storage/base.py, database.py)
+from storage.base import SHARED_TABLES, MANIFEST_TABLE, MANIFEST_STATE_TABLE, QUEUE_STATE_TABLE, POST_HISTORY_TABLE
+from database import NOTIFY_CHANNEL
+
 """
 Utility functions to perform a variety of actions on the postgreSQL database.
 
 To use, replace the code in main() with the desired actions.
 
+To create every bot's tables, or upgrade them to the latest schema, run:
+
+python db_utils.py migrate
+
+To move every bot into the shared tables (see SCHEMA MIGRATIONS below), run:
+
+python db_utils.py migrate_shared
+
 """
 
 with open('../keys.json') as key_data:
@@ -16,11 +32,15 @@ with open('../keys.json') as key_data:
     database_url = key_dict['app']['database_url']
     parsed_url = urlparse(database_url)
     
+    # Every key other than "app" describes a bot
+    bot_dict = {key: value for key, value in key_dict.items() if key != 'app'}
+    
     
 def main():
     """
     EXAMPLE CODE:
     
+    migrate()
     create_table('example_queue', 'filepath text', 'timestamp timestamp')
     create_table('example_recent_queue', 'filepath text', 'timestamp timestamp')
     create_table('example_request_sent', 'id text', 'screen_name text', 'timestamp timestamp')
@@ -28,6 +48,7 @@ def main():
     clear_table('example_queue')
     insert_row('example_queue', 'filepath', 'example_string')
     insert_row_into_queue('example_queue', 'example_string', comment=None)
+    insert_row_into_queue('queue', 'example_string', comment=None, bot='example')
     delete_row('example_queue', 'filepath', 'example_string')
     """
     
@@ -119,7 +140,7 @@ def insert_row(table_name, field, id):
     conn = create_connection()
     cur = conn.cursor()
     
-    timestamp = str(datetime.datetime.now())
+    timestamp = datetime.datetime.now()
     
     cur.execute("INSERT INTO {0} ({1}, timestamp) VALUES ('{2}', '{3}')".format(table_name, field, id, timestamp))
     
@@ -129,14 +150,24 @@ def insert_row(table_name, field, id):
 
 # Insertion specifically into queue tables
 # Queue tables now have the following fields:
-# filepath, comment, timestamp
-def insert_row_into_queue(table_name, filepath, comment=None):
+# id, filepath, comment, timestamp, bot
+# bot (the screen_name of the bot) is required for the shared queue table
+# The row goes to the front of the queue: it gets an id below every id in use
+def insert_row_into_queue(table_name, filepath, comment=None, bot=None):
     conn = create_connection()
     cur = conn.cursor()
     
-    timestamp = str(datetime.datetime.now())
+    timestamp = datetime.datetime.now()
     
-    cur.execute("INSERT INTO {0} (filepath, comment, timestamp) VALUES (%s, %s, %s)".format(table_name), (filepath, comment, timestamp))
+    # Keep the bot from inserting (and taking ids) until this row is committed
+    cur.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(table_name))
+    
+    if bot is None:
+        cur.execute("""INSERT INTO {0} (id, filepath, comment, timestamp)
+                       VALUES ((SELECT coalesce(min(id), 1) - 1 FROM {0}), %s, %s, %s)""".format(table_name), (filepath, comment, timestamp))
+    else:
+        cur.execute("""INSERT INTO {0} (id, bot, filepath, comment, timestamp)
+                       VALUES ((SELECT coalesce(min(id), 1) - 1 FROM {0}), %s, %s, %s, %s)""".format(table_name), (bot, filepath, comment, timestamp))
     
     conn.commit()
     cur.close()
@@ -173,6 +204,404 @@ def get_table_contents(table_name):
 
     return entries
         
+
+
+"""
+SCHEMA MIGRATIONS
+
+Each bot has a queue table, a recent queue table and a request_sent table (named
+in keys.json). The schema_migrations table records which schema version each
+bot's tables are at, so migrate() can be run any number of times: bots that are
+already up to date are skipped, and bots added to keys.json later are created
+from scratch.
+
+Version 1: the original tables, as they were created by hand
+Version 2: native timestamp columns, primary keys, and indexes for the queries
+           the bot runs on every tick (newest row, delete by filepath, lookup
+           by follower id, oldest row of the recent queue)
+Version 3: a bot column (the screen_name of the bot that owns the row) with
+           composite (bot, ...) keys and indexes
+Version 4: the recent queue table becomes a ring of recent_limit slots per bot,
+           keyed by (bot, slot), where slot is a sequence number modulo
+           recent_limit
+Version 5: the manifest and manifest_state tables, which cache each bot's S3
+           file listing (see manifest.py). They are shared by every bot
+Version 6: the queue_state table, one row per bot for the permutation queue mode
+           (see queues.PermutationQueue). It is shared by every bot
+Version 7: the post_history table, the time each file was last posted (see
+           queues.build_weighted_queue). It is shared by every bot
+Version 8: triggers on the queue and recent queue tables that notify the bot
+           process of changes (see storage/postgres.py, FleetMonitor). Needs PostgreSQL 10
+Version 9: claimed_by and claimed_until columns on the queue tables and the
+           queue_state table, so several workers can drain the queues without
+           taking the same file
+Version 10: queue rows are ordered by id (lowest first) instead of by timestamp.
+            Existing rows are renumbered newest timestamp first
+
+When "schema_layout" in keys.json is set to "shared", every bot's rows are kept
+in one queue, one recent_queue and one request_sent table instead, keyed by the
+bot column. Those tables go through the same migrations and are tracked in
+schema_migrations under the name SHARED_TABLES_ENTRY. Run
+
+python db_utils.py migrate_shared
+
+once to move existing per-bot tables into the shared tables.
+
+To change the schema, append a new function to MIGRATIONS. Never edit a migration
+that has already been applied somewhere. Each migration is called with a cursor,
+a dictionary of table names (a bot's keys from keys.json, or SHARED_TABLES) and
+the screen_name of the bot, which is None for the shared tables.
+"""
+
+SHARED_TABLES_ENTRY = '(shared)'
+
+# Columns copied by migrate_shared, excluding surrogate keys which are regenerated
+SHARED_COPY_COLUMNS = {'queue_table': 'bot, filepath, comment, timestamp',
+                       'recent_queue_table': 'bot, slot, seq, filepath, timestamp',
+                       'request_sent_table': 'bot, id, screen_name, timestamp'}
+
+
+def migrate_create_tables(cur, tables, bot):
+    cur.execute("CREATE TABLE IF NOT EXISTS {} (filepath text, comment text, timestamp timestamp)".format(tables['queue_table']))
+    cur.execute("CREATE TABLE IF NOT EXISTS {} (filepath text, timestamp timestamp)".format(tables['recent_queue_table']))
+    cur.execute("CREATE TABLE IF NOT EXISTS {} (id text, screen_name text, timestamp timestamp)".format(tables['request_sent_table']))
+
+
+def migrate_typed_indexed_tables(cur, tables, bot):
+    queue_table = tables['queue_table']
+    recent_queue_table = tables['recent_queue_table']
+    request_sent_table = tables['request_sent_table']
+    
+    for table_name in (queue_table, recent_queue_table, request_sent_table):
+        # Older tables stored timestamps as text, convert the existing rows in place
+        if get_column_type(cur, table_name, 'timestamp') != 'timestamp without time zone':
+            cur.execute("ALTER TABLE {0} ALTER COLUMN timestamp TYPE timestamp USING timestamp::timestamp".format(table_name))
+    
+    # Queue tables can hold the same file more than once (manual submissions), so
+    # they get a surrogate key
+    for table_name in (queue_table, recent_queue_table):
+        if get_column_type(cur, table_name, 'id') is None:
+            cur.execute("ALTER TABLE {} ADD COLUMN id bigserial PRIMARY KEY".format(table_name))
+        
+        cur.execute("CREATE INDEX IF NOT EXISTS {0}_timestamp_idx ON {0} (timestamp)".format(table_name))
+        cur.execute("CREATE INDEX IF NOT EXISTS {0}_filepath_idx ON {0} (filepath)".format(table_name))
+    
+    if get_column_type(cur, queue_table, 'comment') is None:
+        cur.execute("ALTER TABLE {} ADD COLUMN comment text".format(queue_table))
+    
+    # A follower should only ever have one row, drop duplicates before adding the key
+    cur.execute("""DELETE FROM {0} a
+                   USING {0} b
+                   WHERE a.id = b.id
+                   AND a.ctid < b.ctid""".format(request_sent_table))
+    cur.execute("DELETE FROM {} WHERE id IS NULL".format(request_sent_table))
+    
+    if not has_primary_key(cur, request_sent_table):
+        cur.execute("ALTER TABLE {} ADD PRIMARY KEY (id)".format(request_sent_table))
+
+
+def migrate_bot_column(cur, tables, bot):
+    queue_table = tables['queue_table']
+    recent_queue_table = tables['recent_queue_table']
+    request_sent_table = tables['request_sent_table']
+    
+    for table_name in (queue_table, recent_queue_table, request_sent_table):
+        if get_column_type(cur, table_name, 'bot') is None:
+            cur.execute("ALTER TABLE {} ADD COLUMN bot text".format(table_name))
+        
+        # Per-bot tables default to their owner, so rows inserted by hand still work
+        if bot is not None:
+            cur.execute("UPDATE {} SET bot = %s WHERE bot IS NULL".format(table_name), (bot,))
+            cur.execute("ALTER TABLE {} ALTER COLUMN bot SET DEFAULT %s".format(table_name), (bot,))
+        
+        cur.execute("ALTER TABLE {} ALTER COLUMN bot SET NOT NULL".format(table_name))
+    
+    for table_name in (queue_table, recent_queue_table):
+        cur.execute("DROP INDEX IF EXISTS {}_timestamp_idx".format(table_name))
+        cur.execute("DROP INDEX IF EXISTS {}_filepath_idx".format(table_name))
+        cur.execute("CREATE INDEX IF NOT EXISTS {0}_bot_timestamp_idx ON {0} (bot, timestamp)".format(table_name))
+        cur.execute("CREATE INDEX IF NOT EXISTS {0}_bot_filepath_idx ON {0} (bot, filepath)".format(table_name))
+    
+    cur.execute("ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {0}_pkey".format(request_sent_table))
+    cur.execute("ALTER TABLE {} ADD PRIMARY KEY (bot, id)".format(request_sent_table))
+
+
+def migrate_recent_ring(cur, tables, bot):
+    recent_queue_table = tables['recent_queue_table']
+    
+    if get_column_type(cur, recent_queue_table, 'seq') is None:
+        cur.execute("ALTER TABLE {} ADD COLUMN seq bigint".format(recent_queue_table))
+        cur.execute("ALTER TABLE {} ADD COLUMN slot integer".format(recent_queue_table))
+    
+    # Number the existing rows of each bot oldest first. Until a row is moved into
+    # the ring below, it keeps a slot of its own.
+    cur.execute("""UPDATE {0} r
+                   SET seq = numbered.seq, slot = numbered.seq
+                   FROM (SELECT id, row_number() OVER (PARTITION BY bot ORDER BY timestamp, id) - 1 AS seq
+                         FROM {0}) AS numbered
+                   WHERE r.id = numbered.id""".format(recent_queue_table))
+    
+    # Keep the last recent_limit rows of each bot and place them in their ring slots
+    for screen_name, recent_limit in get_recent_limits(bot):
+        params = {'bot': screen_name, 'limit': recent_limit}
+        cur.execute("""DELETE FROM {0}
+                       WHERE bot = %(bot)s
+                       AND seq <= (SELECT max(seq) FROM {0} WHERE bot = %(bot)s) - %(limit)s""".format(recent_queue_table), params)
+        cur.execute("UPDATE {} SET slot = mod(seq, %(limit)s) WHERE bot = %(bot)s".format(recent_queue_table), params)
+    
+    cur.execute("ALTER TABLE {} DROP COLUMN id".format(recent_queue_table))
+    cur.execute("ALTER TABLE {} ALTER COLUMN seq SET NOT NULL".format(recent_queue_table))
+    cur.execute("ALTER TABLE {} ALTER COLUMN slot SET NOT NULL".format(recent_queue_table))
+    cur.execute("ALTER TABLE {} ADD PRIMARY KEY (bot, slot)".format(recent_queue_table))
+    cur.execute("DROP INDEX IF EXISTS {}_bot_timestamp_idx".format(recent_queue_table))
+    cur.execute("CREATE INDEX IF NOT EXISTS {0}_bot_seq_idx ON {0} (bot, seq)".format(recent_queue_table))
+
+
+def migrate_manifest_tables(cur, tables, bot):
+    # These tables are keyed by bot in both layouts, so every target creates the same two tables
+    cur.execute("""CREATE TABLE IF NOT EXISTS {} (bot text NOT NULL,
+                                                  key text NOT NULL,
+                                                  size bigint,
+                                                  etag text,
+                                                  last_modified text,
+                                                  PRIMARY KEY (bot, key))""".format(MANIFEST_TABLE))
+    cur.execute("""CREATE TABLE IF NOT EXISTS {} (bot text PRIMARY KEY,
+                                                  snapshot bigint NOT NULL,
+                                                  marker text,
+                                                  full_refresh timestamp,
+                                                  refreshed timestamp)""".format(MANIFEST_STATE_TABLE))
+
+
+def migrate_queue_state_table(cur, tables, bot):
+    # One row per bot holding its permutation queue (see queues.PermutationQueue)
+    cur.execute("""CREATE TABLE IF NOT EXISTS {} (bot text PRIMARY KEY,
+                                                  seed bigint NOT NULL,
+                                                  size integer NOT NULL,
+                                                  front integer NOT NULL,
+                                                  deferred integer[] NOT NULL,
+                                                  cursor integer NOT NULL,
+                                                  snapshot bigint NOT NULL)""".format(QUEUE_STATE_TABLE))
+
+
+def migrate_post_history_table(cur, tables, bot):
+    # The time each file was last posted, seeded from the recent queue table
+    cur.execute("""CREATE TABLE IF NOT EXISTS {} (bot text NOT NULL,
+                                                  filepath text NOT NULL,
+                                                  last_posted timestamp NOT NULL,
+                                                  PRIMARY KEY (bot, filepath))""".format(POST_HISTORY_TABLE))
+    cur.execute("""INSERT INTO {0} (bot, filepath, last_posted)
+                   SELECT bot, filepath, max(timestamp) FROM {1}
+                   WHERE filepath IS NOT NULL AND timestamp IS NOT NULL
+                   GROUP BY bot, filepath
+                   ON CONFLICT DO NOTHING""".format(POST_HISTORY_TABLE, tables['recent_queue_table']))
+
+
+def migrate_notify_triggers(cur, tables, bot):
+    """
+    Triggers that send a notification on NOTIFY_CHANNEL whenever the queue or the
+    recent queue changes. The queue triggers run once per statement and send the new
+    queue length of each bot the statement touched, so a bulk insert of a whole queue
+    sends one notification per bot, and a notification that arrives twice does no
+    harm. The recent queue trigger sends the time of each tweet.
+    """
+    cur.execute("""CREATE OR REPLACE FUNCTION queue_notify() RETURNS trigger AS $$
+                   DECLARE
+                       changed_bot text;
+                       remaining bigint;
+                   BEGIN
+                       FOR changed_bot IN SELECT DISTINCT bot FROM changed LOOP
+                           EXECUTE format('SELECT count(*) FROM %I.%I WHERE bot = $1', TG_TABLE_SCHEMA, TG_TABLE_NAME)
+                           INTO remaining USING changed_bot;
+                           PERFORM pg_notify('{0}', json_build_object('kind', 'queue', 'bot', changed_bot, 'count', remaining)::text);
+                       END LOOP;
+                       RETURN NULL;
+                   END;
+                   $$ LANGUAGE plpgsql""".format(NOTIFY_CHANNEL))
+    cur.execute("""CREATE OR REPLACE FUNCTION recent_queue_notify() RETURNS trigger AS $$
+                   BEGIN
+                       PERFORM pg_notify('{0}', json_build_object('kind', 'tweet', 'bot', NEW.bot, 'timestamp', NEW.timestamp)::text);
+                       RETURN NULL;
+                   END;
+                   $$ LANGUAGE plpgsql""".format(NOTIFY_CHANNEL))
+
+    queue_table = tables['queue_table']
+    recent_queue_table = tables['recent_queue_table']
+
+    cur.execute("DROP TRIGGER IF EXISTS {0}_notify_insert ON {0}".format(queue_table))
+    cur.execute("""CREATE TRIGGER {0}_notify_insert AFTER INSERT ON {0}
+                   REFERENCING NEW TABLE AS changed
+                   FOR EACH STATEMENT EXECUTE PROCEDURE queue_notify()""".format(queue_table))
+    cur.execute("DROP TRIGGER IF EXISTS {0}_notify_delete ON {0}".format(queue_table))
+    cur.execute("""CREATE TRIGGER {0}_notify_delete AFTER DELETE ON {0}
+                   REFERENCING OLD TABLE AS changed
+                   FOR EACH STATEMENT EXECUTE PROCEDURE queue_notify()""".format(queue_table))
+    cur.execute("DROP TRIGGER IF EXISTS {0}_notify ON {0}".format(recent_queue_table))
+    cur.execute("""CREATE TRIGGER {0}_notify AFTER INSERT OR UPDATE ON {0}
+                   FOR EACH ROW EXECUTE PROCEDURE recent_queue_notify()""".format(recent_queue_table))
+
+
+def migrate_queue_claims(cur, tables, bot):
+    # Lease columns for claiming queue rows and permutation queues (see Storage.claim_queue_row)
+    for table_name in (tables['queue_table'], QUEUE_STATE_TABLE):
+        if get_column_type(cur, table_name, 'claimed_by') is None:
+            cur.execute("ALTER TABLE {} ADD COLUMN claimed_by text".format(table_name))
+        if get_column_type(cur, table_name, 'claimed_until') is None:
+            cur.execute("ALTER TABLE {} ADD COLUMN claimed_until timestamp".format(table_name))
+
+
+def migrate_queue_order(cur, tables, bot):
+    """
+    The queue is ordered by id, lowest first (see database.insert_queue), so that
+    the order no longer depends on the wall clock. Existing rows were ordered newest
+    timestamp first: renumber them in that order above every id in use (so no new
+    id clashes with an old one), and move the id sequence past them.
+    """
+    queue_table = tables['queue_table']
+    
+    cur.execute("""UPDATE {0} SET id = renumbered.new_id
+                   FROM (SELECT id, (SELECT coalesce(max(id), 0) FROM {0}) + row_number() OVER (ORDER BY bot, timestamp DESC, id) AS new_id
+                         FROM {0}) AS renumbered
+                   WHERE {0}.id = renumbered.id""".format(queue_table))
+    cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {}), false)".format(queue_table),
+                (queue_table,))
+    
+    cur.execute("DROP INDEX IF EXISTS {}_bot_timestamp_idx".format(queue_table))
+    cur.execute("CREATE INDEX IF NOT EXISTS {0}_bot_id_idx ON {0} (bot, id)".format(queue_table))
+
+
+MIGRATIONS = [migrate_create_tables,
+              migrate_typed_indexed_tables,
+              migrate_bot_column,
+              migrate_recent_ring,
+              migrate_manifest_tables,
+              migrate_queue_state_table,
+              migrate_post_history_table,
+              migrate_notify_triggers,
+              migrate_queue_claims,
+              migrate_queue_order]
+
+
+# Returns (screen_name, recent_limit) for the bot, or for every bot when bot is None (shared tables)
+def get_recent_limits(bot):
+    return [(bot_keys['screen_name'], bot_keys['recent_limit']) for key, bot_keys in sorted(bot_dict.items())
+            if bot is None or bot_keys['screen_name'] == bot]
+
+
+def get_migration_targets():
+    # Returns (schema_migrations name, table names, bot screen_name) for every set of tables in use
+    if key_dict['app'].get('schema_layout', 'per_bot') == 'shared':
+        return [(SHARED_TABLES_ENTRY, SHARED_TABLES, None)]
+    
+    return [(key, bot_keys, bot_keys['screen_name']) for key, bot_keys in sorted(bot_dict.items())]
+
+
+def migrate(targets=None):
+    """
+    Bring every set of tables up to the latest schema version. Each target is upgraded
+    in its own transaction per version, so a failure leaves that target at its last
+    completed version. Returns True if every target is up to date.
+    """
+    if targets is None:
+        targets = get_migration_targets()
+    
+    conn = create_connection()
+    cur = conn.cursor()
+    
+    cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (bot text PRIMARY KEY,
+                                                                 version integer NOT NULL,
+                                                                 timestamp timestamp NOT NULL)""")
+    conn.commit()
+    
+    success = True
+    
+    for name, tables, bot in targets:
+        cur.execute("SELECT version FROM schema_migrations WHERE bot = %s", (name,))
+        row = cur.fetchone()
+        version = 0 if row is None else row[0]
+        
+        for target_version in range(version + 1, len(MIGRATIONS) + 1):
+            try:
+                MIGRATIONS[target_version - 1](cur, tables, bot)
+                cur.execute("""INSERT INTO schema_migrations (bot, version, timestamp) VALUES (%s, %s, %s)
+                               ON CONFLICT (bot) DO UPDATE SET version = EXCLUDED.version, timestamp = EXCLUDED.timestamp""",
+                            (name, target_version, datetime.datetime.now()))
+                conn.commit()
+                print("{0}: Migrated to version {1}.".format(name, target_version))
+            except psycopg2.Error as error:
+                conn.rollback()
+                print("{0}: Migration to version {1} failed. {2}".format(name, target_version, error))
+                success = False
+                break
+    
+    cur.close()
+    conn.close()
+    
+    return success
+
+
+def migrate_shared():
+    """
+    Move every bot's rows from its own queue, recent queue and request_sent tables
+    into the shared tables, then drop the per-bot tables. Both sets of tables are
+    migrated to the latest version first so their columns match.
+
+    Each bot is moved in a single transaction. Afterwards, set "schema_layout" to
+    "shared" in keys.json.
+    """
+    per_bot_targets = [(key, bot_keys, bot_keys['screen_name']) for key, bot_keys in sorted(bot_dict.items())]
+    
+    if not migrate(per_bot_targets + [(SHARED_TABLES_ENTRY, SHARED_TABLES, None)]):
+        print("Tables are not up to date. Nothing was moved.")
+        return
+    
+    conn = create_connection()
+    cur = conn.cursor()
+    
+    for key, bot_keys, bot in per_bot_targets:
+        try:
+            for table_key, columns in sorted(SHARED_COPY_COLUMNS.items()):
+                # Queue rows get new ids, given out in queue order
+                order = " ORDER BY id" if table_key == 'queue_table' else ""
+                cur.execute("""INSERT INTO {0} ({2})
+                               SELECT {2} FROM {1}{3}
+                               ON CONFLICT DO NOTHING""".format(SHARED_TABLES[table_key], bot_keys[table_key], columns, order))
+                cur.execute("DROP TABLE {}".format(bot_keys[table_key]))
+            
+            cur.execute("DELETE FROM schema_migrations WHERE bot = %s", (key,))
+            conn.commit()
+            print("{0}: Moved to the shared tables.".format(key))
+        except psycopg2.Error as error:
+            conn.rollback()
+            print("{0}: Could not move to the shared tables. {1}".format(key, error))
+    
+    cur.close()
+    conn.close()
+    
+    
+# Returns the data type of a column, or None if the column does not exist
+def get_column_type(cur, table_name, column_name):
+    cur.execute("""SELECT data_type FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s""",
+                (table_name.lower(), column_name))
+    
+    row = cur.fetchone()
+    
+    return None if row is None else row[0]
+    
+    
+# Check if the table has a primary key (returns either True or False)
+def has_primary_key(cur, table_name):
+    cur.execute("""SELECT 1 FROM information_schema.table_constraints
+                   WHERE table_schema = current_schema() AND table_name = %s AND constraint_type = 'PRIMARY KEY'""",
+                (table_name.lower(),))
+    
+    return cur.fetchone() is not None
+        
         
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        migrate()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'migrate_shared':
+        migrate_shared()
+    else:
+        main()
\ No newline at end of file